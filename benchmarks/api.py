@@ -0,0 +1,356 @@
+"""
+Seed a synthetic dataset and measure filesystem API latency and queries per request.
+
+Seed once, then run either in-process (Django test client) or against gunicorn:
+
+    python -m benchmarks.api seed --users 3 --files 100000 --depth 6 --fanout 3 --links 1000
+    python -m benchmarks.api run --driver inprocess --requests 300 --output inprocess.json
+    python -m benchmarks.api run --driver gunicorn --workers 2 --concurrency 8 --output gunicorn.json
+
+Settings come from benchmarks.settings: SQLite in the temp dir by default, or the
+POSTGRES_* database with BENCH_DATABASE=postgres.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+
+MIME_TYPES = ["image/jpeg", "image/png", "video/mp4", "application/pdf", "text/plain"]
+BATCH_SIZE = 5000
+
+
+def setup_django():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+    import django
+
+    django.setup()
+
+
+def rss_kb(pid="self"):
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    values[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return values
+
+
+def seed(options):
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from django.utils import timezone
+
+    from cloud.filesystem.models import File, Folder, SharedLink, StorageUsage
+
+    call_command("migrate", verbosity=0)
+    rng = random.Random(options.seed)  # noqa: S311
+    now = timezone.now()
+
+    for u in range(options.users):
+        user, _ = User.objects.get_or_create(username=f"bench-{u}")
+        SharedLink.objects.filter(file__owner=user).delete()
+        existing = File.objects.filter(owner=user)
+        existing._raw_delete(existing.db)
+        Folder.objects.filter(owner=user).delete()
+        StorageUsage.objects.filter(user=user).delete()
+
+        folders = []
+        level = [None]
+        for depth in range(options.depth):
+            rows = [
+                Folder(
+                    owner=user,
+                    parent=parent,
+                    name=f"d{depth}-{i}",
+                    path=parent.subtree_path if parent else "/",
+                )
+                for parent in level
+                for i in range(options.fanout)
+            ]
+            level = Folder.objects.bulk_create(rows)
+            folders.extend(level)
+        targets = [None, *folders]
+
+        created = 0
+        while created < options.files:
+            count = min(BATCH_SIZE, options.files - created)
+            File.objects.bulk_create(
+                File(
+                    owner=user,
+                    name=f"file-{created + i}.{rng.choice(['jpg', 'png', 'mp4', 'pdf', 'txt'])}",
+                    folder=rng.choice(targets),
+                    file="bench/placeholder",
+                    size=rng.randint(1_000, 50_000_000),
+                    mime_type=rng.choice(MIME_TYPES),
+                    deleted_at=now - timedelta(days=rng.randint(0, 40)) if rng.random() < 0.05 else None,
+                )
+                for i in range(count)
+            )
+            created += count
+
+        sample = list(
+            File.objects.filter(owner=user, deleted_at__isnull=True).values_list("id", flat=True)[:options.links]
+        )
+        SharedLink.objects.bulk_create(SharedLink(file_id=file_id) for file_id in sample)
+        print(f"bench-{u}: {options.files} files, {len(folders)} folders, {len(sample)} links")
+
+
+def scenarios(user):
+    from cloud.filesystem.models import File, Folder, SharedLink
+
+    live = File.objects.filter(owner=user, deleted_at__isnull=True)
+    files = [str(pk) for pk in live.values_list("id", flat=True)[:200]]
+    folders = list(Folder.objects.filter(owner=user).order_by("-path").values_list("id", flat=True)[:50])
+    top = list(Folder.objects.filter(owner=user, parent__isnull=True).values_list("id", flat=True))
+    tokens = [str(t) for t in SharedLink.objects.filter(file__owner=user).values_list("token", flat=True)[:200]]
+    if not files or not folders:
+        sys.exit("No benchmark data for this user, run `python -m benchmarks.api seed` first")
+
+    return {
+        "files_list": lambda i: "/api/files/?page_size=100",
+        "file_detail": lambda i: f"/api/files/{files[i % len(files)]}/",
+        "file_download": lambda i: f"/api/files/{files[i % len(files)]}/download/",
+        "trash_list": lambda i: "/api/files/trash/?page_size=100",
+        "folder_tree": lambda i: "/api/folders/?depth=1",
+        "folder_content": lambda i: f"/api/folders/{folders[i % len(folders)]}/content/",
+        "folder_size": lambda i: f"/api/folders/{top[i % len(top)]}/size/",
+        "folder_breadcrumbs": lambda i: f"/api/folders/{folders[i % len(folders)]}/breadcrumbs/",
+        "public_link": lambda i: f"/api/p/{tokens[i % len(tokens)]}/" if tokens else None,
+    }
+
+
+def summarize(name, timings, statuses, queries, memory):
+    timings = sorted(timings)
+    ms = [t * 1000 for t in timings]
+    quantiles = statistics.quantiles(ms, n=100, method="inclusive") if len(ms) > 1 else ms * 99
+    return {
+        "scenario": name,
+        "requests": len(ms),
+        "p50_ms": round(quantiles[49], 3),
+        "p90_ms": round(quantiles[89], 3),
+        "p99_ms": round(quantiles[98], 3),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "max_ms": round(ms[-1], 3),
+        "queries_per_request": round(statistics.fmean(queries), 2) if queries else None,
+        "statuses": {str(code): statuses.count(code) for code in sorted(set(statuses))},
+        "memory_kb": memory,
+    }
+
+
+def run_inprocess(options, user, urls):
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    client = Client()
+    client.force_login(user)
+    results = []
+    for name, url_for in urls.items():
+        if (options.scenarios and name not in options.scenarios) or url_for(0) is None:
+            continue
+        for i in range(options.warmup):
+            client.get(url_for(i))
+        timings, statuses, queries = [], [], []
+        for i in range(options.requests):
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                response = client.get(url_for(i))
+                timings.append(time.perf_counter() - start)
+            statuses.append(response.status_code)
+            queries.append(len(ctx.captured_queries))
+        results.append(summarize(name, timings, statuses, queries, rss_kb()))
+        print_result(results[-1])
+    return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit("gunicorn exited during startup")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    sys.exit("gunicorn did not start listening")
+
+
+def worker_pids(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            return [int(child) for child in children.read().split()]
+    except OSError:
+        return []
+
+
+def read_log_lines(path, offset):
+    with open(path) as log:
+        log.seek(offset)
+        lines = [json.loads(line) for line in log if line.strip()]
+        return lines, log.tell()
+
+
+def run_gunicorn(options, user, urls):
+    from django.conf import settings
+    from django.test import Client
+
+    client = Client()
+    client.force_login(user)
+    cookie = f"{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}"
+
+    port = free_port()
+    log_path = tempfile.NamedTemporaryFile(prefix="cloud-bench-", suffix=".log", delete=False).name
+    env = {**os.environ, "BENCH_REQUEST_LOG": log_path}
+    process = subprocess.Popen(  # noqa: S603
+        [
+            sys.executable, "-m", "gunicorn", "cloud.wsgi:application",
+            "--bind", f"127.0.0.1:{port}",
+            "--workers", str(options.workers),
+            "--log-level", "warning",
+            "--chdir", os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ],
+        env=env,
+    )
+    results = []
+    try:
+        wait_for_port(port, process)
+
+        def fetch(url):
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            try:
+                start = time.perf_counter()
+                conn.request("GET", url, headers={"Cookie": cookie, "Host": "localhost"})
+                response = conn.getresponse()
+                response.read()
+                return time.perf_counter() - start, response.status
+            finally:
+                conn.close()
+
+        offset = 0
+        with ThreadPoolExecutor(max_workers=options.concurrency) as pool:
+            for name, url_for in urls.items():
+                if (options.scenarios and name not in options.scenarios) or url_for(0) is None:
+                    continue
+                list(pool.map(fetch, [url_for(i) for i in range(options.warmup)]))
+                _, offset = read_log_lines(log_path, offset)
+                measured = list(pool.map(fetch, [url_for(i) for i in range(options.requests)]))
+                time.sleep(0.2)
+                lines, offset = read_log_lines(log_path, offset)
+                memory = {str(pid): rss_kb(pid) for pid in worker_pids(process.pid)}
+                results.append(summarize(
+                    name,
+                    [elapsed for elapsed, _ in measured],
+                    [code for _, code in measured],
+                    [line["db_queries"] for line in lines],
+                    memory,
+                ))
+                print_result(results[-1])
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        os.remove(log_path)
+    return results
+
+
+def print_result(result):
+    print(
+        f"{result['scenario']:>20}: p50 {result['p50_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms  "
+        f"queries {result['queries_per_request']}  statuses {result['statuses']}"
+    )
+
+
+def run(options):
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.db.models import Count
+
+    user = User.objects.filter(username=options.user).annotate(files_count=Count("files")).first()
+    if user is None:
+        sys.exit(f"User {options.user} not found, run `python -m benchmarks.api seed` first")
+    urls = scenarios(user)
+    driver = run_gunicorn if options.driver == "gunicorn" else run_inprocess
+    results = driver(options, user, urls)
+
+    report = {
+        "driver": options.driver,
+        "database": settings.DATABASES["default"]["ENGINE"].rsplit(".", 1)[-1],
+        "user": options.user,
+        "files": user.files_count,
+        "requests_per_scenario": options.requests,
+        "workers": options.workers if options.driver == "gunicorn" else None,
+        "concurrency": options.concurrency if options.driver == "gunicorn" else 1,
+        "python": platform.python_version(),
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def git_commit():
+    try:
+        return subprocess.run(  # noqa: S603
+            ["git", "rev-parse", "--short", "HEAD"],  # noqa: S607
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="Create benchmark users, folders, files and links")
+    seed_parser.add_argument("--users", type=int, default=1)
+    seed_parser.add_argument("--files", type=int, default=10_000, help="Files per user")
+    seed_parser.add_argument("--depth", type=int, default=5, help="Folder tree depth")
+    seed_parser.add_argument("--fanout", type=int, default=3, help="Subfolders per folder")
+    seed_parser.add_argument("--links", type=int, default=500, help="Share links per user")
+    seed_parser.add_argument("--seed", type=int, default=0)
+
+    run_parser = commands.add_parser("run", help="Measure the API against seeded data")
+    run_parser.add_argument("--driver", choices=["inprocess", "gunicorn"], default="inprocess")
+    run_parser.add_argument("--user", default="bench-0")
+    run_parser.add_argument("--requests", type=int, default=200, help="Measured requests per scenario")
+    run_parser.add_argument("--warmup", type=int, default=10)
+    run_parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    run_parser.add_argument("--concurrency", type=int, default=4, help="Concurrent clients for gunicorn")
+    run_parser.add_argument("--scenarios", nargs="+", help="Only run these scenarios")
+    run_parser.add_argument("--output", help="Write JSON results to this path")
+
+    options = parser.parse_args()
+    setup_django()
+    if options.command == "seed":
+        seed(options)
+    else:
+        run(options)
+
+
+if __name__ == "__main__":
+    main()
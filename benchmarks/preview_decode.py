@@ -0,0 +1,121 @@
+"""
+Compare the old and the draft-mode preview decode paths on large synthetic images.
+
+Each measurement runs in a fresh process so peak RSS reflects a single decode:
+
+    python -m benchmarks.preview_decode --megapixels 12 24 48 --output decode.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from PIL import Image
+
+
+MODES = {
+    "rgb_jpeg": ("RGB", "JPEG", "jpg"),
+    "gray_jpeg": ("L", "JPEG", "jpg"),
+    "cmyk_jpeg": ("CMYK", "JPEG", "jpg"),
+    "rgb_png": ("RGB", "PNG", "png"),
+}
+
+
+def make_image(directory, megapixels, mode_name):
+    mode, pil_format, ext = MODES[mode_name]
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    noise = Image.effect_noise((width // 8, height // 8), 64).resize((width, height))
+    image = Image.merge("RGB", (noise, noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT), noise))
+    path = os.path.join(directory, f"{mode_name}_{megapixels}mp.{ext}")
+    image.convert(mode).save(path, format=pil_format, quality=90)
+    return path
+
+
+def decode_baseline(path):
+    image = Image.open(path)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((300, 300))
+    return image.size
+
+
+def decode_draft(path):
+    from cloud.previews import open_thumbnail
+
+    return open_thumbnail(path, (300, 300)).size
+
+
+def peak_rss_kb():
+    # VmHWM belongs to the current address space, unlike ru_maxrss which survives exec.
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(args):
+    variant, path = args
+    if variant == "draft":
+        import django
+
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cloud.settings.test")
+        django.setup()
+        from cloud import previews  # noqa: F401
+    decode = decode_draft if variant == "draft" else decode_baseline
+    before = peak_rss_kb()
+    start = time.perf_counter()
+    size = decode(path)
+    elapsed = time.perf_counter() - start
+    peak = peak_rss_kb()
+    return {"seconds": elapsed, "peak_rss_delta_kb": peak - before, "size": size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--megapixels", type=int, nargs="+", default=[12, 24, 48])
+    parser.add_argument("--modes", nargs="+", choices=sorted(MODES), default=sorted(MODES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write JSON results to this path")
+    options = parser.parse_args()
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        for megapixels in options.megapixels:
+            for mode_name in options.modes:
+                path = make_image(directory, megapixels, mode_name)
+                for variant in ("baseline", "draft"):
+                    runs = []
+                    for _ in range(options.repeat):
+                        with context.Pool(1, maxtasksperchild=1) as pool:
+                            runs.append(pool.apply(measure, ((variant, path),)))
+                    result = {
+                        "image": mode_name,
+                        "megapixels": megapixels,
+                        "variant": variant,
+                        "seconds_min": min(run["seconds"] for run in runs),
+                        "peak_rss_delta_kb_max": max(run["peak_rss_delta_kb"] for run in runs),
+                    }
+                    results.append(result)
+                    print(
+                        f"{mode_name:>10} {megapixels:>3} MP {variant:>8}: "
+                        f"{result['seconds_min'] * 1000:8.1f} ms "
+                        f"{result['peak_rss_delta_kb_max'] / 1024:8.1f} MB"
+                    )
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
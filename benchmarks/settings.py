@@ -0,0 +1,62 @@
+import os
+import tempfile
+
+from cloud.settings.test import *  # noqa: F403
+from cloud.settings.test import env
+
+
+DEBUG = False
+ALLOWED_HOSTS = ["*"]
+
+if os.environ.get("BENCH_DATABASE") == "postgres":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": env("POSTGRES_DB"),
+            "USER": env("POSTGRES_USER"),
+            "PASSWORD": env("POSTGRES_PASSWORD"),
+            "HOST": env("POSTGRES_HOST", "db"),
+            "PORT": env("POSTGRES_PORT", "5432"),
+        }
+    }
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.environ.get(
+                "BENCH_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "cloud-bench.sqlite3")
+            ),
+        }
+    }
+
+# gunicorn workers are separate processes, so sessions must not live in a per-process cache.
+SESSION_ENGINE = "django.contrib.sessions.backends.signed_cookies"
+
+# Redis does not cull, but locmem drops entries past 300 by default.
+CACHES = {
+    "default": {
+        **CACHES["default"],  # noqa: F405
+        "OPTIONS": {"MAX_ENTRIES": 1_000_000},
+    }
+}
+
+REST_FRAMEWORK = {
+    **REST_FRAMEWORK,  # noqa: F405
+    "DEFAULT_THROTTLE_CLASSES": (),
+}
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {"json": {"format": "%(message)s"}},
+    "handlers": {
+        "requests": {
+            "class": "logging.FileHandler",
+            "filename": os.environ.get("BENCH_REQUEST_LOG", os.devnull),
+            "formatter": "json",
+        },
+    },
+    "loggers": {
+        "json": {"handlers": ["requests"], "level": "INFO", "propagate": False},
+    },
+}
@@ -0,0 +1,42 @@
+import asyncio
+import weakref
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from django_redis.cache import RedisCache as DjangoRedisCache
+from redis import asyncio as aioredis
+
+from cloud.metrics import record_cache
+
+
+# redis.asyncio connections belong to the event loop that opened them, and cache
+# backends are instantiated per request context, so pools are kept per loop and URL.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+class RedisCache(DjangoRedisCache):
+    """django-redis backend whose aget/aset/adelete talk to Redis natively instead of via a thread."""
+
+    def _async_client(self):
+        clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+        url = self.client._server[0]
+        if url not in clients:
+            clients[url] = aioredis.Redis.from_url(url)
+        return clients[url]
+
+    async def aget(self, key, default=None, version=None):
+        value = await self._async_client().get(self.client.make_key(key, version=version))
+        record_cache(int(value is not None), int(value is None))
+        return default if value is None else self.client.decode(value)
+
+    async def aset(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is not None and timeout <= 0:
+            return await self.adelete(key, version=version)
+        px = int(timeout * 1000) if timeout is not None else None
+        key = self.client.make_key(key, version=version)
+        return bool(await self._async_client().set(key, self.client.encode(value), px=px))
+
+    async def adelete(self, key, version=None):
+        return bool(await self._async_client().delete(self.client.make_key(key, version=version)))
@@ -0,0 +1,93 @@
+import logging
+import posixpath
+import zipfile
+
+from django.core.files.storage import default_storage
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Recompressing these only burns CPU, so they go into the archive as-is.
+STORED_MIME_PREFIXES = ("image/", "video/", "audio/")
+STORED_MIME_TYPES = {
+    "application/zip",
+    "application/gzip",
+    "application/x-7z-compressed",
+    "application/x-bzip2",
+    "application/x-rar-compressed",
+    "application/x-xz",
+    "application/pdf",
+}
+
+
+class _Sink:
+    """Write-only file object that hands zipfile's output back to the generator."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def compress_type(mime_type):
+    if mime_type.startswith(STORED_MIME_PREFIXES) or mime_type in STORED_MIME_TYPES:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def unique_name(arcname, seen):
+    root, ext = posixpath.splitext(arcname)
+    candidate, n = arcname, 1
+    while candidate in seen:
+        candidate = f"{root} ({n}){ext}"
+        n += 1
+    seen.add(candidate)
+    return candidate
+
+
+def stream_zip(entries):
+    """Yield a ZIP of (arcname, storage name, mime type, modified) entries without seeking."""
+    sink = _Sink()
+    seen = set()
+    with zipfile.ZipFile(sink, "w", allowZip64=True) as archive:
+        for arcname, name, mime_type, modified in entries:
+            try:
+                source = default_storage.open(name, "rb")
+            except FileNotFoundError:
+                logger.warning("stream_zip: %s is missing, skipping %s", name, arcname)
+                continue
+            info = zipfile.ZipInfo(
+                unique_name(arcname, seen), date_time=timezone.localtime(modified).timetuple()[:6]
+            )
+            info.compress_type = compress_type(mime_type)
+            with source, archive.open(info, "w", force_zip64=True) as dest:
+                for chunk in iter(lambda source=source: source.read(CHUNK_SIZE), b""):
+                    dest.write(chunk)
+                    if data := sink.drain():
+                        yield data
+            if data := sink.drain():
+                yield data
+    yield sink.drain()
+
+
+def archive_response(entries, filename):
+    response = StreamingHttpResponse(stream_zip(entries), content_type="application/zip")
+    response["Content-Disposition"] = content_disposition_header(True, f"{filename}.zip")
+    response["X-Accel-Buffering"] = "no"
+    # Entries are already deflated or deliberately stored; gzip would only recompress them.
+    response.skip_gzip = True
+    return response
@@ -0,0 +1,138 @@
+"""Async versions of the download, preview and public-link endpoints, served under cloud.asgi.
+
+They answer like the DRF views but await the ORM and the cache instead of holding a worker.
+Django cannot wrap coroutine views in ATOMIC_REQUESTS, so they opt out of it; the one write,
+the download claim, is a single conditional UPDATE.
+"""
+import math
+
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import require_safe
+
+from asgiref.sync import sync_to_async
+from rest_framework.settings import api_settings
+
+from .. import previews
+from . import responses
+from .models import File, SharedLink
+
+
+def _error(message, status, key="error"):
+    return JsonResponse({key: message}, status=status)
+
+
+def _throttle_wait(request):
+    throttles = [throttle_class() for throttle_class in api_settings.DEFAULT_THROTTLE_CLASSES]
+    waits = [throttle.wait() for throttle in throttles if not throttle.allow_request(request, None)]
+    if not waits:
+        return None
+    return max((wait for wait in waits if wait is not None), default=0)
+
+
+async def _authorize(request):
+    """Apply what DRF would: session auth, IsAuthenticated and the default throttles."""
+    user = await request.auser()
+    if not user.is_authenticated:
+        return _error("Authentication credentials were not provided.", 403, key="detail")
+    request.user = user
+    # DRF throttles keep their history in the sync cache API.
+    wait = await sync_to_async(_throttle_wait)(request)
+    if wait is not None:
+        response = _error(f"Request was throttled. Expected available in {math.ceil(wait)} seconds.", 429, key="detail")
+        response["Retry-After"] = str(math.ceil(wait))
+        return response
+    return None
+
+
+async def _owned_file(request, pk):
+    return await File.objects.select_related("blob").filter(
+        pk=pk, owner_id=request.user.id, deleted_at__isnull=True
+    ).afirst()
+
+
+@transaction.non_atomic_requests
+@require_safe
+async def download(request, pk):
+    if (denied := await _authorize(request)) is not None:
+        return denied
+    file_obj = await _owned_file(request, pk)
+    if file_obj is None:
+        return _error("No File matches the given query.", 404, key="detail")
+    if not file_obj.file or not file_obj.file.name:
+        return _error("File not found", 404)
+    return await responses.aserve(
+        request,
+        file_obj.file.name,
+        file_obj.mime_type or "application/octet-stream",
+        etag=responses.content_etag(file_obj),
+        last_modified=file_obj.updated_at,
+        filename=file_obj.name,
+    )
+
+
+@transaction.non_atomic_requests
+@require_safe
+async def preview(request, pk):
+    if (denied := await _authorize(request)) is not None:
+        return denied
+    file_obj = await _owned_file(request, pk)
+    if file_obj is None:
+        return _error("No File matches the given query.", 404, key="detail")
+    size = request.GET.get("size")
+    if size is not None:
+        if size not in settings.PREVIEW_RENDITIONS:
+            return _error("Unknown preview size", 400)
+        content_type = previews.negotiate_format(request.headers.get("Accept", ""))
+        # Renditions are rendered with Pillow on first request.
+        name = await sync_to_async(previews.render, thread_sensitive=False)(file_obj, size, content_type)
+    else:
+        content_type = "image/jpeg"
+        name = file_obj.preview_image.name if file_obj.preview_image else None
+    if not name:
+        return _error("Preview not available", 404)
+    response = await responses.aserve(
+        request,
+        name,
+        content_type,
+        etag=responses.content_etag(file_obj, variant=name),
+        last_modified=file_obj.updated_at,
+        cache_control="private, max-age=3600",
+    )
+    patch_vary_headers(response, ["Accept"])
+    return response
+
+
+@transaction.non_atomic_requests
+@require_safe
+async def public_file(request, token):
+    if (denied := await _authorize(request)) is not None:
+        return denied
+    link = await SharedLink.aresolve(token)
+    if link is None or (link["expires_at"] is not None and timezone.now() > link["expires_at"]):
+        return _error("Link is invalid or expired", 404)
+    if not link["file_name"]:
+        return _error("File not found", 404)
+
+    etag = responses.etag_for(link["sha256"], link["file_id"], link["updated_at"])
+    response = await responses.aserve(
+        request,
+        link["file_name"],
+        link["mime_type"] or "application/octet-stream",
+        etag=etag,
+        last_modified=link["updated_at"],
+        filename=link["name"],
+    )
+    # Revalidations and resumed ranges are not new downloads, but still need one left.
+    if response.status_code in (200, 206):
+        if responses.starts_download(request, etag):
+            allowed = await SharedLink.aclaim_download(link["id"])
+        else:
+            allowed = await SharedLink.ahas_downloads_left(link["id"])
+        if not allowed:
+            response.close()
+            return _error("Link is invalid or expired", 404)
+    return response
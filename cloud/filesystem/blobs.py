@@ -0,0 +1,75 @@
+import hashlib
+import os
+import uuid
+
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from cloud.utils import blob_upload_path, staging_upload_path
+
+from .models import Blob
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def staging_path():
+    name = staging_upload_path(None, uuid.uuid4().hex)
+    os.makedirs(os.path.dirname(default_storage.path(name)), exist_ok=True)
+    return name
+
+
+def stage(chunks):
+    """Write an upload to staging and hash it, before any lock is taken.
+
+    Returns the (name, sha256, size) that promote() takes.
+    """
+    name = staging_path()
+    digest = hashlib.sha256()
+    size = 0
+    with open(default_storage.path(name), "wb") as out:
+        for chunk in chunks:
+            digest.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    return name, digest.hexdigest(), size
+
+
+def hash_staged(name):
+    digest = hashlib.sha256()
+    size = 0
+    with open(default_storage.path(name), "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return name, digest.hexdigest(), size
+
+
+def promote(name, sha256, size):
+    blob_name = blob_upload_path(None, sha256)
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(sha256=sha256).first()
+        if blob is None:
+            try:
+                with transaction.atomic():
+                    blob = Blob.objects.create(sha256=sha256, file=blob_name, size=size, ref_count=1)
+            except IntegrityError:
+                blob = Blob.objects.select_for_update().get(sha256=sha256)
+            else:
+                _move(name, blob_name)
+                return blob
+
+        if blob.ref_count == 0:
+            _move(name, blob_name)
+        else:
+            default_storage.delete(name)
+        Blob.objects.filter(pk=blob.pk).update(ref_count=F("ref_count") + 1)
+        blob.ref_count += 1
+    return blob
+
+
+def _move(name, blob_name):
+    path = default_storage.path(blob_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(default_storage.path(name), path)
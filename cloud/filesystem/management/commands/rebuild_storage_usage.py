@@ -0,0 +1,37 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cloud.filesystem.models import StorageUsage
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Recalculate per-user storage usage counters from File rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, action="append", dest="users", help="Only rebuild these user ids")
+        parser.add_argument("--dry-run", action="store_true", help="Report drift without writing")
+
+    def handle(self, *args, users=None, dry_run=False, **options):
+        user_ids = users or User.objects.values_list("id", flat=True)
+        fixed = 0
+        for user_id in user_ids:
+            with transaction.atomic():
+                usage = StorageUsage.objects.select_for_update().filter(user_id=user_id).first()
+                totals = StorageUsage.totals(user_id)
+                if usage is not None and (usage.used_bytes, usage.trash_bytes) == (
+                    totals["used_bytes"],
+                    totals["trash_bytes"],
+                ):
+                    continue
+                self.stdout.write(
+                    f"user {user_id}: used {usage.used_bytes if usage else None} -> {totals['used_bytes']}, "
+                    f"trash {usage.trash_bytes if usage else None} -> {totals['trash_bytes']}"
+                )
+                fixed += 1
+                if not dry_run:
+                    StorageUsage.objects.update_or_create(user_id=user_id, defaults=totals)
+        self.stdout.write(self.style.SUCCESS(f"{fixed} counters {'out of date' if dry_run else 'rebuilt'}"))
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_paths(apps, schema_editor):
+    Folder = apps.get_model('filesystem', 'Folder')
+    children = {}
+    for folder_id, parent_id in Folder.objects.values_list('id', 'parent_id'):
+        children.setdefault(parent_id, []).append(folder_id)
+
+    stack = [(folder_id, '/') for folder_id in children.get(None, [])]
+    while stack:
+        folder_id, path = stack.pop()
+        Folder.objects.filter(pk=folder_id).update(path=path)
+        stack.extend((child_id, f'{path}{folder_id}/') for child_id in children.get(folder_id, []))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filesystem', '0004_storageusage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='path',
+            field=models.CharField(default='/', max_length=1024),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(fields=['path'], name='folder_path_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_sequences(apps, schema_editor):
+    # Existing rows become change 1 so that a first sync from 0 still lists them.
+    ChangeSequence = apps.get_model('filesystem', 'ChangeSequence')
+    File = apps.get_model('filesystem', 'File')
+    Folder = apps.get_model('filesystem', 'Folder')
+    owners = set(File.objects.values_list('owner_id', flat=True).distinct())
+    owners |= set(Folder.objects.values_list('owner_id', flat=True).distinct())
+    ChangeSequence.objects.bulk_create([ChangeSequence(user_id=owner_id, seq=1) for owner_id in owners])
+    File.objects.update(change_seq=1)
+    Folder.objects.update(change_seq=1)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('filesystem', '0009_folder_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeSequence',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='change_sequence', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('seq', models.BigIntegerField(default=0)),
+                ('pruned_seq', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('file', 'File'), ('folder', 'Folder')], max_length=10)),
+                ('object_id', models.CharField(max_length=36)),
+                ('change_seq', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='change_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='change_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['owner', 'change_seq'], name='file_change_seq_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(fields=['owner', 'change_seq'], name='folder_change_seq_idx'),
+        ),
+        migrations.AddField(
+            model_name='tombstone',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='tombstone',
+            index=models.Index(fields=['owner', 'change_seq'], name='tombstone_change_seq_idx'),
+        ),
+        migrations.RunPython(backfill_sequences, migrations.RunPython.noop),
+    ]
@@ -1,37 +1,228 @@
 import uuid
+from datetime import timedelta
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import models, transaction
+from django.db.models import Case, F, Max, Q, Sum, Value, When
+from django.db.models.functions import Concat, Substr
 from django.utils import timezone
 
-from cloud.utils import file_upload_path, preview_upload_path
+from cloud.utils import (
+    blob_upload_path,
+    file_upload_path,
+    preview_upload_path,
+    rendition_dir,
+    unlink_files,
+)
 
 
 User = get_user_model()
 
 
+RESTORE_WINDOW = timedelta(days=30)
+
+
+class QuotaExceededError(Exception):
+    pass
+
+
 class Folder(models.Model):
     name = models.CharField(max_length=255)
     owner = models.ForeignKey(User, on_delete=models.CASCADE,  related_name="folders")
     parent = models.ForeignKey(
         "self", null=True, blank=True, on_delete=models.CASCADE, related_name="children"
     )
+    path = models.CharField(max_length=1024, default="/")
     created_at = models.DateField(auto_now_add=True)
+    version = models.PositiveIntegerField(default=0)
+    change_seq = models.BigIntegerField(default=0)
 
     class Meta:
         unique_together = ('owner', 'parent', 'name')
         ordering = ["created_at"]
-    
+        indexes = [
+            models.Index(fields=["path"], name="folder_path_idx", opclasses=["varchar_pattern_ops"]),
+            models.Index(fields=["owner", "change_seq"], name="folder_change_seq_idx"),
+        ]
+
     def __str__(self):
         return self.name
 
-    
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not update_fields:
+            return
+        if self._state.adding:
+            self.path = self.parent.subtree_path if self.parent_id else "/"
+        else:
+            # Cached representations are keyed by version.
+            self.version += 1
+        if update_fields:
+            kwargs["update_fields"] = [*update_fields, "version", "change_seq"]
+        with transaction.atomic(savepoint=False):
+            if not self._state.adding:
+                Folder.objects.select_for_update().filter(pk=self.pk).exists()
+            self.change_seq = ChangeSequence.advance(self.owner_id)
+            super().save(*args, **kwargs)
+
+    @property
+    def subtree_path(self):
+        return f"{self.path}{self.id}/"
+
+    def ancestor_ids(self):
+        return [int(folder_id) for folder_id in self.path.strip("/").split("/") if folder_id]
+
+    def descendants(self):
+        return Folder.objects.filter(owner_id=self.owner_id, path__startswith=self.subtree_path)
+
+    def subtree_files(self):
+        return File.objects.filter(
+            Q(folder_id=self.id) | Q(folder__path__startswith=self.subtree_path), owner_id=self.owner_id
+        )
+
+    def is_descendant_of(self, folder):
+        return self.path.startswith(folder.subtree_path)
+
+    def move_to(self, parent):
+        old_prefix = self.subtree_path
+        # The subtree is locked before save() takes the change sequence.
+        Folder.objects.select_for_update().filter(
+            Q(pk=self.pk) | Q(path__startswith=old_prefix), owner_id=self.owner_id
+        ).exists()
+        self.parent = parent
+        self.path = parent.subtree_path if parent else "/"
+        self.save(update_fields=["parent", "path"])
+        Folder.objects.filter(owner_id=self.owner_id, path__startswith=old_prefix).update(path=Concat(Value(self.subtree_path), Substr("path", len(old_prefix) + 1)))
+
+
+
+class Blob(models.Model):
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to=blob_upload_path)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.sha256
+
+    @classmethod
+    def release(cls, blob_ids):
+        counts = {}
+        for blob_id in blob_ids:
+            counts[blob_id] = counts.get(blob_id, 0) + 1
+        if not counts:
+            return
+        decrement = Case(*(When(pk=blob_id, then=count) for blob_id, count in counts.items()))
+        cls.objects.filter(pk__in=counts).update(ref_count=F("ref_count") - decrement)
+        transaction.on_commit(lambda: cls.collect(list(counts)))
+
+    @classmethod
+    def collect(cls, blob_ids):
+        for blob_id in blob_ids:
+            with transaction.atomic():
+                blob = cls.objects.select_for_update().filter(pk=blob_id, ref_count=0).first()
+                if blob is None:
+                    continue
+                try:
+                    blob.delete()
+                except models.ProtectedError:
+                    # Re-referenced meanwhile; the file stays with the row.
+                    continue
+                # Unlinked under the row lock: a promote() of the same content waits for it,
+                # then finds no row and moves its own file into place.
+                default_storage.delete(blob.file.name)
+
+
+class FileQuerySet(models.QuerySet):
+    @staticmethod
+    def _owner_totals(rows):
+        totals = {}
+        for _, owner_id, size in rows:
+            totals[owner_id] = totals.get(owner_id, 0) + size
+        return totals.items()
+
+    @staticmethod
+    def _owner_ids(rows):
+        ids = {}
+        for file_id, owner_id, *_ in rows:
+            ids.setdefault(owner_id, []).append(file_id)
+        return ids.items()
+
+    def trash(self):
+        now = timezone.now()
+        with transaction.atomic():
+            rows = list(self.filter(deleted_at__isnull=True).select_for_update().values_list("id", "owner_id", "size"))
+            if not rows:
+                return 0
+            for owner_id, size in self._owner_totals(rows):
+                StorageUsage.adjust(owner_id, used=-size, trash=size)
+            for owner_id, ids in self._owner_ids(rows):
+                File.objects.filter(pk__in=ids).update(
+                    deleted_at=now, updated_at=now, change_seq=ChangeSequence.advance(owner_id)
+                )
+        return len(rows)
+
+    def restore(self):
+        now = timezone.now()
+        with transaction.atomic():
+            rows = list(
+                self.filter(deleted_at__gt=now - RESTORE_WINDOW)
+                .select_for_update()
+                .values_list("id", "owner_id", "size")
+            )
+            if not rows:
+                return 0
+            for owner_id, size in self._owner_totals(rows):
+                StorageUsage.reserve(owner_id, size, from_trash=True)
+            for owner_id, ids in self._owner_ids(rows):
+                File.objects.filter(pk__in=ids).update(
+                    deleted_at=None, updated_at=now, change_seq=ChangeSequence.advance(owner_id)
+                )
+        return len(rows)
+
+    def purge(self):
+        with transaction.atomic():
+            # Locked first, so a concurrent purge of the same rows waits and then finds them gone.
+            rows = list(self.select_for_update().values_list(
+                "id", "owner_id", "size", "deleted_at", "blob_id", "file", "preview_image"
+            ))
+            if not rows:
+                return 0
+
+            ids = [row[0] for row in rows]
+            usage = {}
+            names = []
+            for file_id, owner_id, size, deleted_at, blob_id, name, preview_name in rows:
+                used, trash = usage.get(owner_id, (0, 0))
+                usage[owner_id] = (used, trash - size) if deleted_at else (used - size, trash)
+                if preview_name:
+                    names.append(preview_name)
+                if blob_id is None and name:
+                    names.append(name)
+                names.append(rendition_dir(file_id))
+
+            SharedLink.forget(SharedLink.objects.filter(file_id__in=ids).values_list("token", flat=True))
+            File.objects.filter(pk__in=ids).delete()
+            for owner_id, (used, trash) in usage.items():
+                StorageUsage.adjust(owner_id, used=used, trash=trash)
+            Blob.release(row[4] for row in rows if row[4] is not None)
+            for owner_id, owner_ids in self._owner_ids(rows):
+                Tombstone.record(Tombstone.FILE, owner_id, owner_ids, ChangeSequence.advance(owner_id))
+            transaction.on_commit(lambda: unlink_files(names))
+        return len(rows)
+
+
 class File(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=255)
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="files")
     folder = models.ForeignKey(Folder, null=True, blank=True, on_delete=models.SET_NULL, related_name="files")
     file = models.FileField(upload_to=file_upload_path)
+    blob = models.ForeignKey(Blob, null=True, blank=True, on_delete=models.PROTECT, related_name="files")
     preview_image = models.ImageField(upload_to=preview_upload_path, null=True, blank=True)
     size = models.BigIntegerField()
     mime_type = models.CharField(max_length=100)
@@ -39,17 +230,179 @@ class File(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     deleted_at = models.DateTimeField(null=True, blank=True)
     duration_ms = models.BigIntegerField(null=True, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    video_codec = models.CharField(max_length=32, blank=True, default="")
+    change_seq = models.BigIntegerField(default=0)
+
+    objects = FileQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["owner", "-uploaded_at", "-id"],
+                name="file_live_uploaded_idx",
+                condition=Q(deleted_at__isnull=True),
+            ),
+            models.Index(
+                fields=["owner", "folder", "-uploaded_at", "-id"],
+                name="file_live_folder_idx",
+                condition=Q(deleted_at__isnull=True),
+            ),
+            models.Index(
+                fields=["owner", "-deleted_at", "-id"],
+                name="file_trash_idx",
+                condition=Q(deleted_at__isnull=False),
+            ),
+            models.Index(
+                fields=["deleted_at"],
+                name="file_trash_purge_idx",
+                condition=Q(deleted_at__isnull=False),
+            ),
+            models.Index(fields=["owner", "change_seq"], name="file_change_seq_idx"),
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not update_fields:
+            return
+        if update_fields:
+            kwargs["update_fields"] = [*update_fields, "change_seq"]
+        with transaction.atomic(savepoint=False):
+            if not self._state.adding:
+                File.objects.select_for_update().filter(pk=self.pk).exists()
+            self.change_seq = ChangeSequence.advance(self.owner_id)
+            super().save(*args, **kwargs)
+
     def is_deleted(self):
         return self.deleted_at is not None
     
     def can_restore(self):
         if not self.is_deleted():
             return False
-        return (timezone.now() - self.deleted_at).days < 30
+        return timezone.now() - self.deleted_at < RESTORE_WINDOW
+
+    def purge(self):
+        File.objects.filter(pk=self.pk).purge()
+
+
+class StorageUsage(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="storage_usage")
+    used_bytes = models.BigIntegerField(default=0)
+    trash_bytes = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user_id}: {self.used_bytes}"
+
+    @staticmethod
+    def totals(user_id):
+        return File.objects.filter(owner_id=user_id).aggregate(
+            used_bytes=Sum("size", filter=Q(deleted_at__isnull=True), default=0),
+            trash_bytes=Sum("size", filter=Q(deleted_at__isnull=False), default=0),
+        )
+
+    @classmethod
+    def for_user(cls, user_id):
+        usage = cls.objects.filter(user_id=user_id).first()
+        if usage is None:
+            usage, _ = cls.objects.get_or_create(user_id=user_id, defaults=cls.totals(user_id))
+        return usage
+
+    def has_room(self, size):
+        return self.used_bytes + size <= settings.QUOTA_STORAGE_BYTES_PER_USER
+
+    @classmethod
+    def reserve(cls, user_id, size, from_trash=False):
+        with transaction.atomic():
+            usage = cls.objects.select_for_update().filter(user_id=user_id).first()
+            if usage is None:
+                cls.for_user(user_id)
+                usage = cls.objects.select_for_update().get(user_id=user_id)
+            if not usage.has_room(size):
+                raise QuotaExceededError
+            cls.adjust(user_id, used=size, trash=-size if from_trash else 0)
+
+    @classmethod
+    def adjust(cls, user_id, used=0, trash=0):
+        if used or trash:
+            cls.objects.filter(user_id=user_id).update(
+                used_bytes=F("used_bytes") + used,
+                trash_bytes=F("trash_bytes") + trash,
+                updated_at=timezone.now(),
+            )
+
+
+class ChangeSequence(models.Model):
+    """Per-user counter stamped on every file, folder and tombstone change, for sync clients."""
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="change_sequence")
+    seq = models.BigIntegerField(default=0)
+    # Tombstones up to here have been pruned, so older tokens cannot be served.
+    pruned_seq = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user_id}: {self.seq}"
+
+    @classmethod
+    def current(cls, user_id):
+        sequence = cls.objects.filter(user_id=user_id).first()
+        return sequence or cls(user_id=user_id)
+
+    @classmethod
+    def advance(cls, user_id):
+        """Take the next number. Call it in the writing transaction: the row lock held until
+        commit makes numbers commit in order, so a reader of `seq` never skips a later commit.
+
+        Take it last. Writers lock file rows, then folder rows, then StorageUsage, then blobs,
+        then the sequence, so two requests touching the same rows cannot deadlock.
+        """
+        with transaction.atomic(savepoint=False):
+            sequence = cls.objects.select_for_update().filter(user_id=user_id).first()
+            if sequence is None:
+                cls.objects.get_or_create(user_id=user_id)
+                sequence = cls.objects.select_for_update().get(user_id=user_id)
+            sequence.seq += 1
+            sequence.save(update_fields=["seq"])
+        return sequence.seq
+
+
+class Tombstone(models.Model):
+    FILE = "file"
+    FOLDER = "folder"
+    KIND_CHOICES = [(FILE, "File"), (FOLDER, "Folder")]
+
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.CharField(max_length=36)
+    change_seq = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["owner", "change_seq"], name="tombstone_change_seq_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id}"
+
+    @classmethod
+    def record(cls, kind, owner_id, ids, seq):
+        cls.objects.bulk_create(
+            [cls(owner_id=owner_id, kind=kind, object_id=str(object_id), change_seq=seq) for object_id in ids],
+            batch_size=1000,
+        )
+
+    @classmethod
+    def prune(cls, before):
+        with transaction.atomic():
+            expired = cls.objects.filter(created_at__lt=before)
+            for owner_id, seq in expired.values("owner_id").annotate(seq=Max("change_seq")).values_list("owner_id", "seq"):
+                ChangeSequence.objects.filter(user_id=owner_id, pruned_seq__lt=seq).update(pruned_seq=seq)
+            return expired.delete()[0]
 
 
 class SharedLink(models.Model):
@@ -62,7 +415,15 @@ class SharedLink(models.Model):
 
     def __str__(self):
         return self.token
-    
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        SharedLink.forget([self.token])
+
+    def delete(self, *args, **kwargs):
+        SharedLink.forget([self.token])
+        return super().delete(*args, **kwargs)
+
     def is_expired(self):
         return self.expires_at is not None and timezone.now() > self.expires_at
 
@@ -74,5 +435,102 @@ class SharedLink(models.Model):
         return True
 
     def increment_download(self):
-        self.download_count += 1
-        self.save()
+        return SharedLink.claim_download(self.pk)
+
+    @staticmethod
+    def cache_key(token):
+        return f"shared-link:{token}"
+
+    @classmethod
+    def forget(cls, tokens):
+        keys = [cls.cache_key(token) for token in tokens]
+        if keys:
+            transaction.on_commit(lambda: cache.delete_many(keys))
+
+    @staticmethod
+    def cache_entry(link):
+        """The cached view of a link and the timeout to cache it for; unknown tokens get an empty entry."""
+        timeout = settings.SHARED_LINK_CACHE_TIMEOUT
+        if link is None:
+            return {}, timeout
+        file_obj = link.file
+        entry = {
+            "id": link.pk,
+            "expires_at": link.expires_at,
+            "max_downloads": link.max_downloads,
+            "file_id": file_obj.pk,
+            "file_name": file_obj.file.name,
+            "name": file_obj.name,
+            "mime_type": file_obj.mime_type,
+            "sha256": file_obj.blob.sha256 if file_obj.blob_id else None,
+            "updated_at": file_obj.updated_at,
+        }
+        if link.expires_at is not None:
+            remaining = (link.expires_at - timezone.now()).total_seconds()
+            timeout = max(min(timeout, int(remaining) + 1), 1)
+        return entry, timeout
+
+    @classmethod
+    def resolve(cls, token):
+        key = cls.cache_key(token)
+        entry = cache.get(key)
+        if entry is None:
+            link = cls.objects.select_related("file__blob").filter(token=token).first()
+            entry, timeout = cls.cache_entry(link)
+            cache.set(key, entry, timeout)
+        return entry or None
+
+    @classmethod
+    async def aresolve(cls, token):
+        key = cls.cache_key(token)
+        entry = await cache.aget(key)
+        if entry is None:
+            link = await cls.objects.select_related("file__blob").filter(token=token).afirst()
+            entry, timeout = cls.cache_entry(link)
+            await cache.aset(key, entry, timeout)
+        return entry or None
+
+    @classmethod
+    def _claimable(cls, link_id):
+        return cls.objects.filter(pk=link_id).filter(
+            Q(max_downloads__isnull=True) | Q(download_count__lt=F("max_downloads"))
+        )
+
+    @classmethod
+    def has_downloads_left(cls, link_id):
+        """Whether a resumed range may still be served; it is not counted itself."""
+        return cls._claimable(link_id).exists()
+
+    @classmethod
+    async def ahas_downloads_left(cls, link_id):
+        return await cls._claimable(link_id).aexists()
+
+    @classmethod
+    def claim_download(cls, link_id):
+        """Count one download, unless that would exceed max_downloads."""
+        return cls._claimable(link_id).update(download_count=F("download_count") + 1) == 1
+
+    @classmethod
+    async def aclaim_download(cls, link_id):
+        return await cls._claimable(link_id).aupdate(download_count=F("download_count") + 1) == 1
+
+
+class UploadSession(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="upload_sessions")
+    folder = models.ForeignKey(Folder, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    file_id = models.UUIDField(default=uuid.uuid4, editable=False)
+    name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    mime_type = models.CharField(max_length=100)
+    path = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+    def received(self):
+        if not default_storage.exists(self.path):
+            return 0
+        return default_storage.size(self.path)
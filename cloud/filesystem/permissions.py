@@ -3,5 +3,5 @@
 
 class IsOwner(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-         return obj.owner == request.user
+         return obj.owner_id == request.user.id
     
\ No newline at end of file
@@ -0,0 +1,132 @@
+import hashlib
+import re
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_etags, quote_etag
+
+from asgiref.sync import sync_to_async
+
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def content_etag(file_obj, variant=""):
+    sha256 = file_obj.blob.sha256 if file_obj.blob_id is not None else None
+    return etag_for(sha256, file_obj.pk, file_obj.updated_at, variant)
+
+
+def etag_for(sha256, file_id, updated_at, variant=""):
+    tag = sha256 or f"{file_id}:{updated_at.timestamp()}"
+    if variant:
+        tag = hashlib.sha256(f"{tag}:{variant}".encode()).hexdigest()
+    return quote_etag(tag)
+
+
+def parse_range(header, size):
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start:
+        if not end or int(end) == 0:
+            return False
+        return max(size - int(end), 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def starts_download(request, etag):
+    """Whether answering this request counts as a new download rather than a resumed one.
+
+    Decided from the request alone: in nginx mode Django answers every Range request with 200.
+    A suffix range (bytes=-N) can ask for the whole file, so it counts.
+    """
+    header = request.headers.get("Range")
+    if_range = request.headers.get("If-Range")
+    if not header or (if_range and etag not in parse_etags(if_range)):
+        return True
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return True
+    start = match.group(1)
+    return not start or int(start) == 0
+
+
+def _read_range(fp, start, length):
+    with fp:
+        fp.seek(start)
+        while length > 0:
+            chunk = fp.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def serve(request, name, content_type, etag, last_modified, filename=None, cache_control=None):
+    """Answer a media request from validators, then through nginx or a range-aware stream."""
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = _media_response(request, name, content_type, etag)
+    if etag:
+        response.headers.setdefault("ETag", etag)
+    if last_modified:
+        response.headers.setdefault("Last-Modified", http_date(timestamp))
+    if cache_control:
+        response["Cache-Control"] = cache_control
+    # Byte ranges must reach the client exactly as stored.
+    response.skip_gzip = True
+    if filename is not None and response.status_code != 304:
+        response["Content-Disposition"] = content_disposition_header(True, filename)
+    return response
+
+
+async def aserve(request, *args, **kwargs):
+    if settings.SERVE_MEDIA_WITH_NGINX:
+        return serve(request, *args, **kwargs)
+    # Streaming from Django stats and opens the file, which must not block the event loop.
+    return await sync_to_async(serve, thread_sensitive=False)(request, *args, **kwargs)
+
+
+def _media_response(request, name, content_type, etag):
+    if settings.SERVE_MEDIA_WITH_NGINX:
+        # nginx serves the bytes and answers Range requests for internal locations itself.
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = "/protected-media/" + name.lstrip("/")
+        response["Accept-Ranges"] = "bytes"
+        return response
+
+    path = default_storage.path(name)
+    size = default_storage.size(name)
+    header = request.headers.get("Range")
+    if_range = request.headers.get("If-Range")
+    if header and (not if_range or etag in parse_etags(if_range)):
+        byte_range = parse_range(header, size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+        if byte_range is not None:
+            start, end = byte_range
+            length = end - start + 1
+            response = StreamingHttpResponse(
+                _read_range(open(path, "rb"), start, length),
+                status=206,
+                content_type=content_type,
+            )
+            response["Content-Range"] = f"bytes {start}-{end}/{size}"
+            response["Content-Length"] = str(length)
+            response["Accept-Ranges"] = "bytes"
+            return response
+
+    response = FileResponse(open(path, "rb"), content_type=content_type)
+    response["Accept-Ranges"] = "bytes"
+    return response
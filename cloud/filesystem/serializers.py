@@ -1,9 +1,52 @@
+from collections import defaultdict
+from functools import cached_property
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.db.models import Q
+
 from rest_framework import serializers
 
-from .models import File, Folder, SharedLink
+from .models import File, Folder, SharedLink, UploadSession
+from .signing import expiry, signed_url
+
+
+# Bump when a cached representation changes shape.
+REPRESENTATION_VERSION = 1
+
+
+class UpdateFieldsMixin:
+    """Write only the submitted columns (plus auto_now ones) on update."""
+
+    def update(self, instance, validated_data):
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        auto_now = [
+            field.name for field in instance._meta.concrete_fields if getattr(field, 'auto_now', False)
+        ]
+        fields = [*validated_data, *auto_now] if validated_data else []
+        instance.save(update_fields=fields)
+        return instance
+
+
+class CachedListSerializer(serializers.ListSerializer):
+    """Read items from the cache by child.cache_key(), serializing and storing only the misses."""
+
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        keys = [self.child.cache_key(item) for item in items]
+        cached = cache.get_many(keys)
+        missing = {}
+        for key, item in zip(keys, items, strict=True):
+            if key not in cached:
+                cached[key] = missing[key] = self.child.to_representation(item)
+        if missing:
+            cache.set_many(missing, settings.SERIALIZER_CACHE_TIMEOUT)
+        return [cached[key] for key in keys]
 
 
-class FileSerializer(serializers.ModelSerializer):
+class FileSerializer(UpdateFieldsMixin, serializers.ModelSerializer):
     full_url = serializers.SerializerMethodField()
     preview_url = serializers.SerializerMethodField()
     download_url = serializers.SerializerMethodField()
@@ -16,13 +59,24 @@ class FileSerializer(serializers.ModelSerializer):
         model = File
         fields = [
             "id", "name", "size", "mime_type", "uploaded_at", "folder",
-            "preview_url", "full_url", "download_url", "file"
+            "preview_url", "full_url", "download_url", "file",
+            "duration_ms", "width", "height",
         ]
+        read_only_fields = ["duration_ms", "width", "height"]
         extra_kwargs = {
             "size": {"read_only": True},
             "mime_type": {"read_only": True},
             "uploaded_at": {"read_only": True},
         }
+        list_serializer_class = CachedListSerializer
+
+    @cached_property
+    def url_scope(self):
+        # Absolute and signed URLs depend on the host and on the current signing window.
+        return f"{self.build_url(self.context.get('request'), '/')}:{settings.SIGNED_URL_MODE}:{expiry()}"
+
+    def cache_key(self, obj):
+        return f"repr:{REPRESENTATION_VERSION}:file:{obj.pk}:{obj.updated_at.timestamp()}:{self.url_scope}"
 
     def build_url(self, request, path):
         return request.build_absolute_uri(path) if request else path
@@ -33,12 +87,15 @@ class FileSerializer(serializers.ModelSerializer):
 
     def get_preview_url(self, obj):
         if obj.preview_image:
-            return obj.preview_image.url 
+            if obj.deleted_at is not None:
+                return obj.preview_image.url
+            return self.build_url(self.context.get("request"), signed_url(obj.preview_image.name, obj.owner_id))
 
     def get_download_url(self, obj):
         request = self.context.get("request")
-        url = f"/api/files/{obj.id}/download/"
-        return self.build_url(request, url)
+        if obj.deleted_at is not None or not obj.file:
+            return self.build_url(request, f"/api/files/{obj.id}/download/")
+        return self.build_url(request, signed_url(obj.file.name, obj.owner_id, obj.name))
 
 
 class SharedLinkSerializer(serializers.ModelSerializer):
@@ -47,8 +104,80 @@ class SharedLinkSerializer(serializers.ModelSerializer):
         fields = ['id', 'token', 'created_at', 'expires_at', 'max_downloads', 'downloads_count']
 
 
-class FolderSerializer(serializers.ModelSerializer):
-    files = FileSerializer(many=True, read_only=True)
+class FileIdsSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.UUIDField(), allow_empty=False)
+
+    def validate_ids(self, value):
+        if len(value) > settings.BULK_MAX_FILES:
+            raise serializers.ValidationError(f'At most {settings.BULK_MAX_FILES} files per request')
+        return list(dict.fromkeys(value))
+
+
+class BulkMoveSerializer(FileIdsSerializer):
+    folder = serializers.IntegerField(allow_null=True)
+
+
+class FolderNodeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Folder
+        fields = ['id', 'name', 'created_at', 'parent']
+        list_serializer_class = CachedListSerializer
+
+    def cache_key(self, obj):
+        return f"repr:{REPRESENTATION_VERSION}:folder:{obj.pk}:{obj.version}"
+
+
+class FolderTree:
+    def __init__(self, folders, files, context):
+        self.nodes = {}
+        self.children = defaultdict(list)
+        for node in FolderNodeSerializer(folders, many=True, context=context).data:
+            self.nodes[node['id']] = node
+            self.children[node['parent']].append(node['id'])
+        self.files = defaultdict(list)
+        for data in FileSerializer(files, many=True, context=context).data:
+            self.files[data['folder']].append(data)
+
+    @classmethod
+    def for_owner(cls, owner_id, context, root=None):
+        folders = Folder.objects.filter(owner_id=owner_id)
+        if root is not None:
+            folders = folders.filter(Q(pk=root.pk) | Q(path__startswith=root.subtree_path))
+        files = File.objects.filter(
+            owner_id=owner_id, folder__in=folders.values('pk'), deleted_at__isnull=True
+        ).order_by('uploaded_at')
+        return cls(folders, files, context)
+
+    def node(self, folder_id, children=None):
+        node = self.nodes[folder_id]
+        return {
+            'id': node['id'],
+            'name': node['name'],
+            'created_at': node['created_at'],
+            'files': self.files.get(folder_id, []),
+            'children': children,
+            'parent': node['parent'],
+        }
+
+    def render(self, folder_ids, depth=None):
+        result = []
+        stack = [(folder_id, result, 0) for folder_id in reversed(folder_ids)]
+        while stack:
+            folder_id, siblings, level = stack.pop()
+            expand = depth is None or level < depth
+            node = self.node(folder_id, [] if expand else None)
+            siblings.append(node)
+            if expand:
+                for child_id in reversed(self.children.get(folder_id, [])):
+                    stack.append((child_id, node['children'], level + 1))
+        return result
+
+    def flat(self):
+        return [self.node(folder_id) | {'children': self.children.get(folder_id, [])} for folder_id in self.nodes]
+
+
+class FolderSerializer(UpdateFieldsMixin, serializers.ModelSerializer):
+    files = serializers.SerializerMethodField()
     children = serializers.SerializerMethodField()
     parent = serializers.PrimaryKeyRelatedField(queryset=Folder.objects.all(), required=False, allow_null=True)
 
@@ -56,5 +185,53 @@ class FolderSerializer(serializers.ModelSerializer):
         model = Folder
         fields = [ 'id', 'name', 'created_at', 'files', 'children', 'parent']
 
+    def validate_parent(self, value):
+        if value is None:
+            return value
+        request = self.context.get('request')
+        if request is not None and value.owner_id != request.user.id:
+            raise serializers.ValidationError("Folder not found")
+        if self.instance is not None and (value.pk == self.instance.pk or value.is_descendant_of(self.instance)):
+            raise serializers.ValidationError("Cannot move a folder into itself")
+        return value
+
+    def get_tree(self, obj):
+        tree = self.context.get('folder_tree')
+        if tree is None or obj.id not in tree.nodes:
+            tree = self.context['folder_tree'] = FolderTree.for_owner(obj.owner_id, self.context, root=obj)
+        return tree
+
+    def get_files(self, obj):
+        # Shallow responses (writes, content listings) leave files and children unexpanded.
+        if self.context.get('shallow'):
+            return None
+        return self.get_tree(obj).files.get(obj.id, [])
+
     def get_children(self, obj):
-        return FolderSerializer(obj.children.all(), many=True, context=self.context).data
+        depth = self.context.get('depth')
+        if depth == 0 or self.context.get('shallow'):
+            return None
+        tree = self.get_tree(obj)
+        return tree.render(tree.children.get(obj.id, []), None if depth is None else depth - 1)
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    offset = serializers.SerializerMethodField()
+    folder = serializers.PrimaryKeyRelatedField(
+        queryset=Folder.objects.all(), required=False, allow_null=True
+    )
+
+    class Meta:
+        model = UploadSession
+        fields = ["id", "name", "size", "mime_type", "folder", "offset", "created_at"]
+        extra_kwargs = {
+            "mime_type": {"required": False},
+        }
+
+    def validate_size(self, value):
+        if value < 0:
+            raise serializers.ValidationError("Size must not be negative")
+        return value
+
+    def get_offset(self, obj):
+        return obj.received()
@@ -1,15 +1,34 @@
-﻿from django.urls import include, path
+﻿from django.conf import settings
+from django.urls import include, path
 
 from rest_framework.routers import DefaultRouter
 
-from .views import FileViewSet, FolderViewSet, PublicSharedFileView
+from . import async_views
+from .views import (
+    ChangesView,
+    FileViewSet,
+    FolderViewSet,
+    PublicSharedFileView,
+    UploadSessionViewSet,
+    signed_media,
+)
 
 
 router = DefaultRouter()
 router.register(r"files", FileViewSet, basename="file")
 router.register(r"folders", FolderViewSet, basename="folder")
+router.register(r"uploads", UploadSessionViewSet, basename="upload")
+
+async_urlpatterns = [
+    path("files/<uuid:pk>/download/", async_views.download, name="file-download"),
+    path("files/<uuid:pk>/preview/", async_views.preview, name="file-preview"),
+    path("p/<str:token>/", async_views.public_file, name="public-file"),
+]
 
 urlpatterns = [
+    *(async_urlpatterns if settings.ASYNC_MEDIA_VIEWS else []),
     path("", include(router.urls)),
+    path("changes/", ChangesView.as_view(), name="changes"),
     path("p/<str:token>/", PublicSharedFileView.as_view(), name="public-file"),
-]
\ No newline at end of file
+    path("media/<path:name>", signed_media, name="signed-media"),
+]
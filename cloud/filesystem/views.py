@@ -1,37 +1,112 @@
-from urllib.parse import quote
+import functools
+import hashlib
+import mimetypes
+import re
+import shutil
+import time
 
 from django.conf import settings
+from django.core.files.storage import default_storage
 from django.db import transaction
-from django.db.models import Sum
+from django.db.models import Count, Q, Sum
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_safe
 
 from drf_yasg.utils import swagger_auto_schema
-from rest_framework import status, viewsets
+from rest_framework import mixins, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from ..tasks import generate_preview
-from .models import File, Folder, SharedLink
+from .. import previews, video
+from ..tasks import queue_previews
+from ..utils import rendition_upload_path
+from . import archives, blobs, responses, signing
+from .models import (
+    ChangeSequence,
+    File,
+    Folder,
+    QuotaExceededError,
+    SharedLink,
+    StorageUsage,
+    Tombstone,
+    UploadSession,
+)
+from .pagination import KeysetPagination
 from .permissions import IsOwner
-from .serializers import FileSerializer, FolderSerializer
+from .serializers import (
+    BulkMoveSerializer,
+    FileIdsSerializer,
+    FileSerializer,
+    FolderNodeSerializer,
+    FolderSerializer,
+    FolderTree,
+    UploadSessionSerializer,
+)
+
+
+CONTENT_RANGE_RE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+UPLOAD_READ_SIZE = 1024 * 1024
+
+
+def listing_etag(request):
+    # Every change to the user's files and folders advances their sequence; the URL, Accept
+    # header and signing window cover everything else the listing's bytes depend on.
+    seq = ChangeSequence.current(request.user.id).seq
+    value = ":".join([
+        str(seq),
+        request.build_absolute_uri(),
+        request.headers.get("Accept", ""),
+        settings.SIGNED_URL_MODE,
+        str(signing.expiry()),
+    ])
+    return quote_etag(hashlib.sha256(value.encode()).hexdigest())
+
+
+def conditional_listing(method):
+    """Answer If-None-Match with 304 while nothing the listing shows has changed."""
+    @functools.wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        # Read before the listing, so a change committed meanwhile can only make the tag stale.
+        etag = listing_etag(request)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = method(self, request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            response['Cache-Control'] = 'private, no-cache'
+        return response
+    return wrapper
 
 
 class FileViewSet(viewsets.ModelViewSet):
     queryset = File.objects.all()
     serializer_class = FileSerializer
     permission_classes = [IsOwner]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         if not self.request.user.is_authenticated:
             return File.objects.none()
-        return File.objects.filter(owner=self.request.user, deleted_at__isnull=True)
-    
+        return File.objects.filter(owner=self.request.user, deleted_at__isnull=True).select_related('blob')
+
+    def perform_content_negotiation(self, request, force=False):
+        # Binary actions answer with the negotiated media type themselves, so an
+        # image-only Accept header must not be rejected by the JSON renderers.
+        return super().perform_content_negotiation(request, force=force or self.action in ('download', 'preview', 'sprite', 'archive'))
+
     def perform_destroy(self, instance):
-        instance.deleted_at = timezone.now()
-        instance.save()
+        # trash() locks the row, so concurrent deletes move the size to the trash once.
+        File.objects.filter(pk=instance.pk).trash()
+
+    @conditional_listing
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
 
     @swagger_auto_schema(
         request_body=None,
@@ -46,24 +121,30 @@ class FileViewSet(viewsets.ModelViewSet):
         if not uploaded_file:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        used = File.objects.filter(owner=request.user, deleted_at__isnull=True).aggregate(s=Sum('size'))['s'] or 0
-        if used + uploaded_file.size > settings.QUOTA_STORAGE_BYTES_PER_USER:
+        if not StorageUsage.for_user(request.user.id).has_room(uploaded_file.size):
             return Response({'error': 'Storage quota exceeded'}, status=status.HTTP_403_FORBIDDEN)
 
         folder = Folder.objects.filter(id=folder, owner=request.user).first() if folder else None
-        file_obj = File(
-            owner=request.user,
-            name=name or uploaded_file.name,
-            size=uploaded_file.size,
-            mime_type=uploaded_file.content_type,
-            folder=folder
-        )
-        file_obj.save() 
-
-        file_obj.file = uploaded_file
-        file_obj.save()
+        staged = blobs.stage(uploaded_file.chunks())
+        try:
+            with transaction.atomic():
+                # Reserved before promoting: a quota failure must not leave a blob file behind.
+                StorageUsage.reserve(request.user.id, uploaded_file.size)
+                blob = blobs.promote(*staged)
+                file_obj = File.objects.create(
+                    owner=request.user,
+                    name=name or uploaded_file.name,
+                    size=uploaded_file.size,
+                    mime_type=uploaded_file.content_type,
+                    file=blob.file.name,
+                    blob=blob,
+                    folder=folder
+                )
+        except QuotaExceededError:
+            default_storage.delete(staged[0])
+            return Response({'error': 'Storage quota exceeded'}, status=status.HTTP_403_FORBIDDEN)
 
-        generate_preview.delay(file_obj.pk)
+        queue_previews([file_obj], interactive=True)
 
         serializer = self.get_serializer(file_obj, context={'request': request})
         return Response(serializer.data, status=201)
@@ -73,23 +154,56 @@ class FileViewSet(viewsets.ModelViewSet):
         file_obj = self.get_object()
         if not file_obj.file or not file_obj.file.name:
             return Response({'error': 'File not found'}, status=status.HTTP_404_NOT_FOUND)
-        internal_path = '/protected-media/' + file_obj.file.name.lstrip('/')
-        response = HttpResponse()
-        response['Content-Type'] = file_obj.mime_type or 'application/octet-stream'
-        response['Content-Disposition'] = f'attachment; filename="{quote(file_obj.name)}"'
-        response['X-Accel-Redirect'] = internal_path
-        return response
+        return responses.serve(
+            request,
+            file_obj.file.name,
+            file_obj.mime_type or 'application/octet-stream',
+            etag=responses.content_etag(file_obj),
+            last_modified=file_obj.updated_at,
+            filename=file_obj.name,
+        )
     
     @action(detail=True)
     def preview(self, request, pk=None):
         file_obj = self.get_object()
-        if not file_obj.preview_image or not file_obj.preview_image.name:
+        size = request.query_params.get('size')
+        if size is not None:
+            if size not in settings.PREVIEW_RENDITIONS:
+                return Response({'error': 'Unknown preview size'}, status=status.HTTP_400_BAD_REQUEST)
+            content_type = previews.negotiate_format(request.headers.get('Accept', ''))
+            name = previews.render(file_obj, size, content_type)
+        else:
+            content_type = 'image/jpeg'
+            name = file_obj.preview_image.name if file_obj.preview_image else None
+        if not name:
             return Response({'error': 'Preview not available'}, status=status.HTTP_404_NOT_FOUND)
-        internal_path = '/protected-media/' + file_obj.preview_image.name.lstrip('/')
-        response = HttpResponse()
-        response['Content-Type'] = 'image/jpeg'
-        response['X-Accel-Redirect'] = internal_path
-        response['Cache-Control'] = 'private, max-age=3600'
+        response = responses.serve(
+            request,
+            name,
+            content_type,
+            etag=responses.content_etag(file_obj, variant=name),
+            last_modified=file_obj.updated_at,
+            cache_control='private, max-age=3600',
+        )
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    @action(detail=True)
+    def sprite(self, request, pk=None):
+        file_obj = self.get_object()
+        name = rendition_upload_path(file_obj, video.SPRITE_NAME)
+        if not file_obj.mime_type.startswith('video/') or not default_storage.exists(name):
+            return Response({'error': 'Sprite not available'}, status=status.HTTP_404_NOT_FOUND)
+        columns, rows = settings.VIDEO_SPRITE_GRID
+        response = responses.serve(
+            request,
+            name,
+            'image/jpeg',
+            etag=responses.content_etag(file_obj, variant=name),
+            last_modified=file_obj.updated_at,
+            cache_control='private, max-age=3600',
+        )
+        response['X-Sprite-Grid'] = f'{columns}x{rows}'
         return response
     
     @action(detail=True, methods=['post'])
@@ -103,7 +217,7 @@ class FileViewSet(viewsets.ModelViewSet):
             file_obj.folder_id = folder_obj.id
         else:
             file_obj.folder_id = None
-        file_obj.save()
+        file_obj.save(update_fields=['folder', 'updated_at'])
         return Response({'message': f'File {file_obj.name} moved'})
     
     @swagger_auto_schema(
@@ -111,7 +225,6 @@ class FileViewSet(viewsets.ModelViewSet):
         request_body=None,
         responses={201: FileSerializer(many=True)},
     )
-    @transaction.atomic
     @action(detail=False, methods=['post'])
     def bulk_upload(self, request):
         files = request.FILES.getlist('files')
@@ -125,26 +238,89 @@ class FileViewSet(viewsets.ModelViewSet):
             except Folder.DoesNotExist:
                 return Response({'error': 'Folder not found'}, status=status.HTTP_400_BAD_REQUEST)
 
-        used = File.objects.filter(owner=request.user, deleted_at__isnull=True).aggregate(s=Sum('size'))['s'] or 0
-        total_new = sum(f.size for f in files)
-        if used + total_new > settings.QUOTA_STORAGE_BYTES_PER_USER:
+        # Copied and hashed before the transaction, so no lock is held while the bytes are read.
+        staged = [blobs.stage(uploaded_file.chunks()) for uploaded_file in files]
+        try:
+            with transaction.atomic():
+                StorageUsage.reserve(request.user.id, sum(f.size for f in files))
+                for uploaded_file, item in zip(files, staged, strict=True):
+                    blob = blobs.promote(*item)
+                    uploaded_files.append(File(
+                        owner=request.user,
+                        name=name or uploaded_file.name,
+                        size=uploaded_file.size,
+                        mime_type=uploaded_file.content_type,
+                        file=blob.file.name,
+                        blob=blob,
+                        folder=folder_obj
+                    ))
+                # The change sequence is taken last and once, after every other lock.
+                change_seq = ChangeSequence.advance(request.user.id)
+                for file_obj in uploaded_files:
+                    file_obj.change_seq = change_seq
+                File.objects.bulk_create(uploaded_files)
+        except QuotaExceededError:
+            for item in staged:
+                default_storage.delete(item[0])
             return Response({'error': 'Storage quota exceeded'}, status=status.HTTP_403_FORBIDDEN)
 
-        for uploaded_file in files:
-            file_obj = File.objects.create(
-                owner=request.user,
-                name=name or uploaded_file.name,
-                size=uploaded_file.size,
-                mime_type=uploaded_file.content_type,
-                file=uploaded_file,
-                folder=folder_obj
-            )
-            uploaded_files.append(file_obj)
-            generate_preview.delay(file_obj.id)
+        queue_previews(uploaded_files)
 
         serializer = self.get_serializer(uploaded_files, many=True, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    def selected_files(self, request, queryset, serializer_class=FileIdsSerializer):
+        serializer = serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        return queryset.filter(pk__in=data['ids']), data
+
+    @action(detail=False, methods=['post'])
+    def archive(self, request):
+        files, _ = self.selected_files(request, self.get_queryset())
+        files = (
+            files.exclude(file='')
+            .order_by('name').values_list('name', 'file', 'mime_type', 'updated_at')
+        )
+        return archives.archive_response(files.iterator(chunk_size=500), 'files')
+
+    @action(detail=False, methods=['post'])
+    def bulk_move(self, request):
+        files, data = self.selected_files(request, self.get_queryset(), BulkMoveSerializer)
+        folder_id = data['folder']
+        if folder_id is not None and not Folder.objects.filter(id=folder_id, owner=request.user).exists():
+            return Response({'message': 'Folder not found'}, status=status.HTTP_400_BAD_REQUEST)
+        with transaction.atomic():
+            # The rows are locked before the change sequence, like every other writer.
+            ids = list(files.select_for_update().values_list('id', flat=True))
+            moved = File.objects.filter(pk__in=ids).update(
+                folder_id=folder_id,
+                updated_at=timezone.now(),
+                change_seq=ChangeSequence.advance(request.user.id),
+            )
+        return Response({'count': moved})
+
+    @action(detail=False, methods=['post'])
+    def bulk_delete(self, request):
+        files, _ = self.selected_files(request, self.get_queryset())
+        return Response({'count': files.trash()})
+
+    @action(detail=False, methods=['post'])
+    def bulk_restore(self, request):
+        files, _ = self.selected_files(request, File.objects.filter(owner=request.user))
+        try:
+            restored = files.restore()
+        except QuotaExceededError:
+            return Response({'error': 'Storage quota exceeded'}, status=status.HTTP_403_FORBIDDEN)
+        return Response({'count': restored})
+
+    @action(detail=False, methods=['post'])
+    def bulk_permanent_delete(self, request):
+        files, _ = self.selected_files(
+            request, File.objects.filter(owner=request.user, deleted_at__isnull=False)
+        )
+        return Response({'count': files.purge()})
+
     @action(detail=True, methods=['post'])
     def share(self, request, pk=None):
         file_obj = self.get_object()
@@ -158,10 +334,13 @@ class FileViewSet(viewsets.ModelViewSet):
     
 
     @action(detail=False, methods=['get'])
+    @conditional_listing
     def trash(self, request):
-        deleted_files = File.objects.filter(owner=request.user, deleted_at__isnull=False).order_by('-deleted_at')
-        serializer = self.get_serializer(deleted_files, many=True, context={'request': request})
-        return Response(serializer.data)
+        deleted_files = File.objects.filter(owner=request.user, deleted_at__isnull=False)
+        paginator = KeysetPagination(field='deleted_at')
+        page = paginator.paginate_queryset(deleted_files, request, view=self)
+        serializer = self.get_serializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
 
 
     @action(detail=True, methods=['post'])
@@ -173,9 +352,15 @@ class FileViewSet(viewsets.ModelViewSet):
         
         if not file_obj.can_restore():
             return Response(status=status.HTTP_403_FORBIDDEN)
-        
-        file_obj.deleted_at = None
-        file_obj.save()
+
+        try:
+            restored = File.objects.filter(pk=file_obj.pk).restore()
+        except QuotaExceededError:
+            return Response({'error': 'Storage quota exceeded'}, status=status.HTTP_403_FORBIDDEN)
+        if not restored:
+            # Restored or purged by a concurrent request.
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        file_obj.refresh_from_db()
         serializer = self.get_serializer(file_obj, context={'request': request})
         return Response(serializer.data)
     
@@ -187,7 +372,7 @@ class FileViewSet(viewsets.ModelViewSet):
         except File.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
         
-        file_obj.delete()
+        file_obj.purge()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -200,42 +385,356 @@ class FolderViewSet(viewsets.ModelViewSet):
         if not self.request.user.is_authenticated:
             return Folder.objects.none()
         return Folder.objects.filter(owner=self.request.user)
+
+    def perform_content_negotiation(self, request, force=False):
+        return super().perform_content_negotiation(request, force=force or self.action == 'archive')
     
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        depth = self.request.query_params.get('depth')
+        if depth is not None:
+            if not depth.isdigit():
+                raise ValidationError({'depth': 'Must be a non-negative integer'})
+            context['depth'] = int(depth)
+        if self.action in ('create', 'update', 'partial_update'):
+            context['shallow'] = True
+        return context
+
+    @conditional_listing
+    def list(self, request, *args, **kwargs):
+        context = self.get_serializer_context()
+        tree = FolderTree.for_owner(request.user.id, context)
+        if request.query_params.get('flat') in ('1', 'true'):
+            return Response(tree.flat())
+        return Response(tree.render(tree.children.get(None, []), context.get('depth')))
+
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
-        
+
+    @transaction.atomic
+    def perform_update(self, serializer):
+        instance = serializer.instance
+        if 'parent' in serializer.validated_data:
+            parent = serializer.validated_data.pop('parent')
+            if parent is not None:
+                # validate_parent() read unlocked paths; a concurrent move could close a cycle.
+                ids = {instance.pk, parent.pk, *parent.ancestor_ids()}
+                locked = Folder.objects.select_for_update().filter(pk__in=ids).order_by('pk').in_bulk()
+                instance.path = locked[instance.pk].path
+                parent = locked[parent.pk]
+                if parent.pk == instance.pk or parent.is_descendant_of(instance):
+                    raise ValidationError({'parent': ['Cannot move a folder into itself']})
+            if (parent.pk if parent else None) != instance.parent_id:
+                instance.move_to(parent)
+        serializer.save()
+
     @transaction.atomic
     def perform_destroy(self, instance):
-        files = File.objects.filter(folder=instance, deleted_at__isnull=True)
-        files.update(deleted_at=timezone.now())
-        instance.delete()
-    
+        files = instance.subtree_files()
+        folders = Folder.objects.filter(
+            Q(pk=instance.pk) | Q(path__startswith=instance.subtree_path), owner_id=instance.owner_id
+        )
+        # Files, then folders, then usage and the change sequence: the order every writer locks in.
+        file_ids = list(files.select_for_update(of=('self',)).values_list('id', flat=True))
+        folder_ids = list(folders.select_for_update().values_list('id', flat=True))
+        # trash() skips files a concurrent request already trashed, so their size moves once.
+        File.objects.filter(pk__in=file_ids).trash()
+        seq = ChangeSequence.advance(instance.owner_id)
+        Tombstone.record(Tombstone.FOLDER, instance.owner_id, folder_ids, seq)
+        # Deleting the folders below clears every subtree file's folder, trashed ones included.
+        files.update(updated_at=timezone.now(), change_seq=seq)
+        Folder.objects.filter(pk__in=folder_ids).delete()
+
+    @action(detail=True)
+    def breadcrumbs(self, request, pk=None):
+        folder = self.get_object()
+        ancestor_ids = folder.ancestor_ids()
+        ancestors = Folder.objects.filter(owner=request.user).in_bulk(ancestor_ids)
+        chain = [ancestors[folder_id] for folder_id in ancestor_ids if folder_id in ancestors] + [folder]
+        return Response([{'id': item.id, 'name': item.name} for item in chain])
+
+    @action(detail=True)
+    def size(self, request, pk=None):
+        folder = self.get_object()
+        totals = folder.subtree_files().filter(deleted_at__isnull=True).aggregate(
+            size=Sum('size', default=0), files=Count('id')
+        )
+        return Response(totals)
+
     @action(detail=True)
+    def archive(self, request, pk=None):
+        folder = self.get_object()
+        parents = {folder.id: (folder.name, None)}
+        parents.update(
+            (item.id, (item.name, item.parent_id))
+            for item in folder.descendants().only('id', 'name', 'parent_id')
+        )
+        prefixes = {}
+
+        def prefix(folder_id):
+            if folder_id not in prefixes:
+                name, parent_id = parents[folder_id]
+                prefixes[folder_id] = f"{prefix(parent_id)}{name}/" if parent_id else f"{name}/"
+            return prefixes[folder_id]
+
+        files = (
+            folder.subtree_files().filter(deleted_at__isnull=True).exclude(file='')
+            .order_by('folder_id', 'name')
+            .values_list('folder_id', 'name', 'file', 'mime_type', 'updated_at')
+        )
+        entries = (
+            (prefix(folder_id) + name, file_name, mime_type, updated_at)
+            for folder_id, name, file_name, mime_type, updated_at in files.iterator(chunk_size=500)
+        )
+        return archives.archive_response(entries, folder.name)
+
+    @action(detail=True)
+    @conditional_listing
     def content(self, request, pk=None):
         folder = self.get_object()
-        subfolders = Folder.objects.filter(parent=folder, owner=request.user)
         files = File.objects.filter(owner=request.user, folder=folder, deleted_at__isnull=True)
-        folder_serializer = FolderSerializer(subfolders, many=True, context={'request': request})
-        file_serializer = FileSerializer(files, many=True, context={'request': request})
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(files, request, view=self)
+        file_serializer = FileSerializer(page, many=True, context={'request': request})
+        folders = []
+        if not request.query_params.get(paginator.cursor_query_param):
+            subfolders = Folder.objects.filter(parent=folder, owner=request.user)
+            folders = FolderSerializer(subfolders, many=True, context={'request': request, 'shallow': True}).data
         return Response({
-            "folders": folder_serializer.data,
-            "files": file_serializer.data
+            "folders": folders,
+            "files": file_serializer.data,
+            "next": paginator.get_next_link(),
+        })
+
+
+class UploadSessionViewSet(
+    mixins.CreateModelMixin,
+    mixins.RetrieveModelMixin,
+    mixins.DestroyModelMixin,
+    viewsets.GenericViewSet,
+):
+    queryset = UploadSession.objects.all()
+    serializer_class = UploadSessionSerializer
+    permission_classes = [IsOwner]
+
+    def get_queryset(self):
+        if not self.request.user.is_authenticated:
+            return UploadSession.objects.none()
+        return UploadSession.objects.filter(owner=self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        name = serializer.validated_data['name']
+        size = serializer.validated_data['size']
+        folder = serializer.validated_data.get('folder')
+        if folder is not None and folder.owner_id != request.user.id:
+            return Response({'error': 'Folder not found'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not StorageUsage.for_user(request.user.id).has_room(size):
+            return Response({'error': 'Storage quota exceeded'}, status=status.HTTP_403_FORBIDDEN)
+
+        path = blobs.staging_path()
+        open(default_storage.path(path), 'wb').close()
+
+        session = serializer.save(
+            owner=request.user,
+            path=path,
+            mime_type=serializer.validated_data.get('mime_type')
+            or mimetypes.guess_type(name)[0]
+            or 'application/octet-stream',
+        )
+        return Response(self.get_serializer(session).data, status=status.HTTP_201_CREATED)
+
+    def perform_destroy(self, instance):
+        if default_storage.exists(instance.path):
+            default_storage.delete(instance.path)
+        instance.delete()
+
+    @swagger_auto_schema(
+        consumes=["application/octet-stream"],
+        request_body=None,
+        responses={200: "offset"},
+    )
+    @action(detail=True, methods=['put'])
+    def chunk(self, request, pk=None):
+        match = CONTENT_RANGE_RE.match(request.headers.get('Content-Range', ''))
+        if match is None:
+            return Response({'error': 'Content-Range header required'}, status=status.HTTP_400_BAD_REQUEST)
+        start, end, total = (int(value) for value in match.groups())
+        length = end - start + 1
+
+        session = self.get_object()
+        if total != session.size or end < start or end >= total:
+            return Response({'error': 'Invalid range'}, status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        if length > settings.UPLOAD_CHUNK_MAX_BYTES:
+            return Response({'error': 'Chunk too large'}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        offset = session.received()
+        if start != offset:
+            return Response({'error': 'Unexpected offset', 'offset': offset}, status=status.HTTP_409_CONFLICT)
+
+        # The body arrives unbuffered and may take minutes, so it goes to a part file
+        # first; the session row is locked only to check the offset and append.
+        part = blobs.staging_path()
+        try:
+            written = 0
+            stream = request.stream
+            with open(default_storage.path(part), 'wb') as out:
+                while stream is not None and written < length:
+                    data = stream.read(min(UPLOAD_READ_SIZE, length - written))
+                    if not data:
+                        break
+                    out.write(data)
+                    written += len(data)
+            if written != length:
+                return Response({'error': 'Incomplete chunk', 'offset': offset}, status=status.HTTP_400_BAD_REQUEST)
+
+            with transaction.atomic():
+                session = get_object_or_404(self.get_queryset().select_for_update(), pk=pk)
+                offset = session.received()
+                if start != offset:
+                    return Response({'error': 'Unexpected offset', 'offset': offset}, status=status.HTTP_409_CONFLICT)
+                with open(default_storage.path(part), 'rb') as src, open(default_storage.path(session.path), 'ab') as out:
+                    shutil.copyfileobj(src, out, UPLOAD_READ_SIZE)
+                session.save(update_fields=['updated_at'])
+        finally:
+            default_storage.delete(part)
+
+        return Response({'offset': offset + written})
+
+    @swagger_auto_schema(request_body=None, responses={201: FileSerializer()})
+    @action(detail=True, methods=['post'])
+    def commit(self, request, pk=None):
+        session = self.get_object()
+        offset = session.received()
+        if offset != session.size:
+            return Response({'error': 'Upload incomplete', 'offset': offset}, status=status.HTTP_409_CONFLICT)
+        # Hashed before any lock: re-reading a large upload must not hold the quota row.
+        staged = blobs.hash_staged(session.path)
+
+        with transaction.atomic():
+            session = get_object_or_404(self.get_queryset().select_for_update(), pk=pk)
+            offset = session.received()
+            if offset != session.size:
+                return Response({'error': 'Upload incomplete', 'offset': offset}, status=status.HTTP_409_CONFLICT)
+
+            try:
+                StorageUsage.reserve(request.user.id, session.size)
+            except QuotaExceededError:
+                return Response({'error': 'Storage quota exceeded'}, status=status.HTTP_403_FORBIDDEN)
+
+            blob = blobs.promote(*staged)
+            file_obj = File.objects.create(
+                id=session.file_id,
+                owner=request.user,
+                name=session.name,
+                size=session.size,
+                mime_type=session.mime_type,
+                file=blob.file.name,
+                blob=blob,
+                folder=session.folder,
+            )
+            session.delete()
+
+        queue_previews([file_obj], interactive=True)
+
+        serializer = FileSerializer(file_obj, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class ChangesView(APIView):
+    """Everything that changed after `since`, up to the returned token, for sync clients."""
+
+    def get(self, request):
+        sequence = ChangeSequence.current(request.user.id)
+        since = request.query_params.get('since', '0')
+        if not since.isdigit() or int(since) > sequence.seq:
+            return Response({'error': 'Invalid change token'}, status=status.HTTP_400_BAD_REQUEST)
+        since = int(since)
+        # Deletions before pruned_seq are forgotten; only a full sync from 0 is still complete.
+        if 0 < since < sequence.pruned_seq:
+            return Response({'error': 'Change token expired'}, status=status.HTTP_410_GONE)
+
+        changes = {
+            'files': File.objects.filter(owner=request.user),
+            'folders': Folder.objects.filter(owner=request.user),
+            'tombstones': Tombstone.objects.filter(owner=request.user),
+        }
+        token = sequence.seq
+        limit = settings.CHANGES_PAGE_SIZE
+        for queryset in changes.values():
+            # Changes sharing a sequence number (a bulk move, a folder delete) are never split.
+            seqs = queryset.filter(change_seq__gt=since).order_by('change_seq').values_list('change_seq', flat=True)
+            overflow = seqs[limit:limit + 1].first()
+            if overflow is not None:
+                token = min(token, overflow - 1 if overflow - 1 > since else overflow)
+        changes = {
+            name: queryset.filter(change_seq__gt=since, change_seq__lte=token)
+            for name, queryset in changes.items()
+        }
+
+        files = list(changes['files'].select_related('blob').order_by('change_seq'))
+        tombstones = list(changes['tombstones'].values_list('kind', 'object_id'))
+        context = {'request': request}
+        return Response({
+            'token': token,
+            'more': token < sequence.seq,
+            'files': FileSerializer(
+                [file for file in files if file.deleted_at is None], many=True, context=context
+            ).data,
+            'folders': FolderNodeSerializer(changes['folders'].order_by('change_seq'), many=True, context=context).data,
+            'deleted': {
+                'files': [str(file.pk) for file in files if file.deleted_at is not None]
+                + [object_id for kind, object_id in tombstones if kind == Tombstone.FILE],
+                'folders': [int(object_id) for kind, object_id in tombstones if kind == Tombstone.FOLDER],
+            },
         })
 
 
 class PublicSharedFileView(APIView):
     def get(self, request, token):
-        shared_link = get_object_or_404(SharedLink, token=token)
-        if not shared_link.is_valid():
+        link = SharedLink.resolve(token)
+        if link is None or (link['expires_at'] is not None and timezone.now() > link['expires_at']):
             return Response({'error': 'Link is invalid or expired'}, status=status.HTTP_404_NOT_FOUND)
-        
-        file_obj = shared_link.file
-        shared_link.increment_download()
-        if not file_obj.file or not file_obj.file.name:
+        if not link['file_name']:
             return Response({'error': 'File not found'}, status=status.HTTP_404_NOT_FOUND)
-        internal_path = '/protected-media/' + file_obj.file.name.lstrip('/')
-        response = HttpResponse()
-        response['Content-Type'] = file_obj.mime_type or 'application/octet-stream'
-        response['Content-Disposition'] = f'attachment; filename="{file_obj.name}"'
-        response['X-Accel-Redirect'] = internal_path
+
+        etag = responses.etag_for(link['sha256'], link['file_id'], link['updated_at'])
+        response = responses.serve(
+            request,
+            link['file_name'],
+            link['mime_type'] or 'application/octet-stream',
+            etag=etag,
+            last_modified=link['updated_at'],
+            filename=link['name'],
+        )
+        # Revalidations and resumed ranges are not new downloads, but still need one left.
+        if response.status_code in (200, 206):
+            if responses.starts_download(request, etag):
+                allowed = SharedLink.claim_download(link['id'])
+            else:
+                allowed = SharedLink.has_downloads_left(link['id'])
+            if not allowed:
+                response.close()
+                return Response({'error': 'Link is invalid or expired'}, status=status.HTTP_404_NOT_FOUND)
         return response
+
+
+@require_safe
+def signed_media(request, name):
+    """Serve a signed media URL on the strength of its signature alone: no session, no query."""
+    refused = signing.verify(name, request.GET)
+    if refused is not None:
+        return HttpResponse(status=refused)
+    filename = request.GET.get("f") or None
+    content_type = mimetypes.guess_type(filename or name)[0] or "application/octet-stream"
+    remaining = int(request.GET["e"]) - int(time.time())
+    return responses.serve(
+        request,
+        name,
+        content_type,
+        etag=None,
+        last_modified=None,
+        filename=filename,
+        cache_control=f"private, max-age={remaining}",
+    )
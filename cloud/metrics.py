@@ -0,0 +1,177 @@
+import json
+import logging
+import threading
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import Http404, HttpResponse
+from django.utils.crypto import constant_time_compare
+
+from django_redis import get_redis_connection
+from django_redis.client import DefaultClient
+from redis.exceptions import RedisError
+
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_MISSING = object()
+
+request_stats = ContextVar("request_stats", default=None)
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = []
+        self.query_count = 0
+        self.query_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+class Registry:
+    """Counters and histograms, rendered in the Prometheus text format.
+
+    Samples are added to a Redis hash shared by every worker process, so any worker's
+    /metrics answers with the totals of all of them. METRICS_STORE = "local" keeps them
+    in this process instead (tests, single-process runs).
+    """
+
+    key = "cloud:metrics"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = {}
+
+    @staticmethod
+    def counter(name, labels, value=1):
+        return {_field(name, labels, None): value}
+
+    @staticmethod
+    def histogram(name, labels, value):
+        fields = {_field(name, labels, bound): 1 for bound in DURATION_BUCKETS if value <= bound}
+        fields[_field(name, labels, "count")] = 1
+        fields[_field(name, labels, "sum")] = value
+        return fields
+
+    def inc(self, name, labels, value=1):
+        self.add(self.counter(name, labels, value))
+
+    def observe(self, name, labels, value):
+        self.add(self.histogram(name, labels, value))
+
+    def add(self, *samples):
+        """Apply several counter/histogram samples in one round trip."""
+        increments = {}
+        for sample in samples:
+            for field, value in sample.items():
+                increments[field] = increments.get(field, 0) + value
+        if settings.METRICS_STORE == "local":
+            with self.lock:
+                for field, value in increments.items():
+                    self.local[field] = self.local.get(field, 0) + value
+            return
+        try:
+            pipe = get_redis_connection("default").pipeline(transaction=False)
+            for field, value in increments.items():
+                pipe.hincrbyfloat(self.key, field, value)
+            pipe.execute()
+        except RedisError:
+            logger.warning("metrics: could not record %s samples", len(increments), exc_info=True)
+
+    def values(self):
+        if settings.METRICS_STORE == "local":
+            with self.lock:
+                return dict(self.local)
+        return {
+            field.decode(): float(value)
+            for field, value in get_redis_connection("default").hgetall(self.key).items()
+        }
+
+    def clear(self):
+        if settings.METRICS_STORE == "local":
+            with self.lock:
+                self.local.clear()
+        else:
+            get_redis_connection("default").delete(self.key)
+
+    def render(self):
+        counters = {}
+        histograms = {}
+        for field, value in self.values().items():
+            name, labels, part = json.loads(field)
+            series = (name, tuple(map(tuple, labels)))
+            if part is None:
+                counters[series] = value
+            else:
+                histograms.setdefault(series, {})[part] = value
+
+        lines = []
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f"{name}{_labels(dict(labels))} {_number(value)}")
+        for (name, labels), parts in sorted(histograms.items()):
+            labels = dict(labels)
+            count = parts.get("count", 0)
+            for bound in DURATION_BUCKETS:
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': str(bound)})} {_number(parts.get(str(bound), 0))}")
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {_number(count)}")
+            lines.append(f"{name}_sum{_labels(labels)} {parts.get('sum', 0)}")
+            lines.append(f"{name}_count{_labels(labels)} {_number(count)}")
+        return "\n".join(lines) + "\n"
+
+
+def _field(name, labels, part):
+    if part is not None:
+        part = str(part)
+    return json.dumps([name, sorted(labels.items()), part], separators=(",", ":"))
+
+
+def _labels(labels):
+    pairs = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+registry = Registry()
+
+
+def record_cache(hits, misses):
+    stats = request_stats.get()
+    if stats is not None:
+        stats.cache_hits += hits
+        stats.cache_misses += misses
+
+
+class CacheStatsMixin:
+    def get(self, key, default=None, version=None, **kwargs):
+        value = super().get(key, _MISSING, version=version, **kwargs)
+        record_cache(int(value is not _MISSING), int(value is _MISSING))
+        return default if value is _MISSING else value
+
+
+class InstrumentedRedisClient(CacheStatsMixin, DefaultClient):
+    def get_many(self, keys, version=None, **kwargs):
+        keys = list(keys)
+        found = super().get_many(keys, version=version, **kwargs)
+        record_cache(len(found), len(keys) - len(found))
+        return found
+
+
+class InstrumentedLocMemCache(CacheStatsMixin, LocMemCache):
+    # BaseCache.get_many() goes through get(), so only get() is wrapped here.
+    pass
+
+
+def metrics_view(request):
+    token = settings.METRICS_TOKEN
+    provided = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not token or not constant_time_compare(provided, token):
+        raise Http404
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
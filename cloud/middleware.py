@@ -0,0 +1,132 @@
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.middleware import gzip
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+from cloud import metrics
+
+
+logger = logging.getLogger("json")
+
+
+def record_query(execute, sql, params, many, context):
+    stats = metrics.request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        stats.query_count += 1
+        stats.query_time += elapsed
+        if len(stats.queries) < settings.SLOW_REQUEST_MAX_QUERIES:
+            stats.queries.append({"ms": round(elapsed * 1000, 3), "sql": sql})
+
+
+def instrument_connections():
+    """Install record_query on this thread's connections; it reports to the current request, if any."""
+    for connection in connections.all():
+        if record_query not in connection.execute_wrappers:
+            # Prepended so that execute_wrapper() blocks still pop their own wrapper.
+            connection.execute_wrappers.insert(0, record_query)
+
+
+class RequestMetricsMiddleware:
+    """Times each request and counts its queries and cache lookups for logs and /metrics."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = metrics.RequestStats()
+        token = metrics.request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            instrument_connections()
+            response = self.get_response(request)
+        finally:
+            metrics.request_stats.reset(token)
+        self.finish(request, response, time.perf_counter() - start, stats)
+        return response
+
+    async def __acall__(self, request):
+        stats = metrics.RequestStats()
+        token = metrics.request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            # The async ORM runs queries on a thread-sensitive worker with its own connections.
+            await sync_to_async(instrument_connections)()
+            response = await self.get_response(request)
+        finally:
+            metrics.request_stats.reset(token)
+        # Recording is a Redis round trip; it must not block the event loop.
+        await sync_to_async(self.finish, thread_sensitive=False)(request, response, time.perf_counter() - start, stats)
+        return response
+
+    def finish(self, request, response, duration, stats):
+        match = request.resolver_match
+        view = match.view_name if match else "unresolved"
+        if view != "metrics":
+            self.record(request, response, view, duration, stats)
+
+    def record(self, request, response, view, duration, stats):
+        size = None if response.streaming else len(response.content)
+        labels = {"view": view, "method": request.method}
+        registry = metrics.registry
+        samples = [
+            registry.counter("cloud_http_requests_total", {**labels, "status": str(response.status_code)}),
+            registry.histogram("cloud_http_request_duration_seconds", labels, duration),
+            registry.counter("cloud_db_queries_total", labels, stats.query_count),
+            registry.counter("cloud_db_query_duration_seconds_total", labels, stats.query_time),
+            registry.counter("cloud_cache_hits_total", labels, stats.cache_hits),
+            registry.counter("cloud_cache_misses_total", labels, stats.cache_misses),
+        ]
+        if size is not None:
+            samples.append(registry.counter("cloud_http_response_bytes_total", labels, size))
+        registry.add(*samples)
+
+        line = {
+            "event": "request",
+            "method": request.method,
+            "path": request.path,
+            "view": view,
+            "status": response.status_code,
+            "duration_ms": round(duration * 1000, 2),
+            "db_queries": stats.query_count,
+            "db_time_ms": round(stats.query_time * 1000, 2),
+            "cache_hits": stats.cache_hits,
+            "cache_misses": stats.cache_misses,
+            "response_bytes": size,
+        }
+        if duration * 1000 >= settings.SLOW_REQUEST_MS:
+            line["event"] = "slow_request"
+            line["queries"] = stats.queries
+            logger.warning(json.dumps(line))
+        else:
+            logger.info(json.dumps(line))
+
+
+class GZipMiddleware(gzip.GZipMiddleware):
+    """GZipMiddleware that leaves responses marked `skip_gzip` alone.
+
+    Compressing a 206 would no longer match its Content-Range, and media bytes are
+    already compressed formats, so streaming them through zlib only costs CPU.
+    """
+
+    def process_response(self, request, response):
+        if getattr(response, "skip_gzip", False):
+            return response
+        return super().process_response(request, response)
@@ -0,0 +1,86 @@
+import contextlib
+import logging
+import os
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from PIL import Image, ImageOps, features
+
+from cloud.utils import rendition_upload_path
+
+
+logger = logging.getLogger(__name__)
+
+RENDITION_FORMATS = {
+    "image/avif": ("AVIF", "avif"),
+    "image/webp": ("WEBP", "webp"),
+    "image/jpeg": ("JPEG", "jpeg"),
+}
+
+
+class ImageTooLargeError(Exception):
+    pass
+
+
+def open_thumbnail(path, size):
+    image = Image.open(path)
+    width, height = image.size
+    if width * height > settings.PREVIEW_MAX_PIXELS:
+        raise ImageTooLargeError(f"{width}x{height} exceeds PREVIEW_MAX_PIXELS")
+    if image.format == "JPEG":
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale before anything loads the full frame.
+        edge = max(size)
+        image.draft("RGB", (edge, edge))
+    ImageOps.exif_transpose(image, in_place=True)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail(size, reducing_gap=settings.PREVIEW_REDUCING_GAP)
+    return image
+
+
+def negotiate_format(accept):
+    for mime_type in ("image/avif", "image/webp"):
+        pil_format = RENDITION_FORMATS[mime_type][0]
+        if mime_type in accept and features.check(pil_format.lower()):
+            return mime_type
+    return "image/jpeg"
+
+
+def rendition_source(file_obj):
+    if file_obj.mime_type.startswith("image/") and file_obj.file:
+        return file_obj.file.path
+    if file_obj.preview_image:
+        return file_obj.preview_image.path
+    return None
+
+
+def render(file_obj, size, mime_type):
+    pil_format, ext = RENDITION_FORMATS[mime_type]
+    name = rendition_upload_path(file_obj, f"{size}.{ext}")
+    if default_storage.exists(name):
+        return name
+
+    source = rendition_source(file_obj)
+    if source is None:
+        return None
+
+    try:
+        image = open_thumbnail(source, settings.PREVIEW_RENDITIONS[size])
+    except (OSError, ImageTooLargeError, Image.DecompressionBombError):
+        # Corrupt, unsupported (HEIC, SVG) or oversized sources have no rendition.
+        logger.warning("render: cannot read %s for %s", source, file_obj.pk, exc_info=True)
+        return None
+
+    path = default_storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        image.save(tmp_path, format=pil_format, quality=settings.PREVIEW_RENDITION_QUALITY)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    return name
@@ -11,9 +11,11 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 import os
+from datetime import timedelta
 from pathlib import Path
 
 from dotenv import load_dotenv
+from kombu import Queue
 
 
 load_dotenv()
@@ -58,7 +60,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-    "django.middleware.gzip.GZipMiddleware",
+    "cloud.middleware.RequestMetricsMiddleware",
+    "cloud.middleware.GZipMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django_permissions_policy.PermissionsPolicyMiddleware",
@@ -88,6 +91,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "cloud.wsgi.application"
+ASGI_APPLICATION = "cloud.asgi.application"
 
 # Database
 DATABASES = {
@@ -159,10 +163,10 @@ SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
 CACHES = {
     "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
+        "BACKEND": "cloud.cache.RedisCache",
         "LOCATION": env("REDIS_URL", "redis://redis:6379/0"),
         "OPTIONS": {
-            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            "CLIENT_CLASS": "cloud.metrics.InstrumentedRedisClient",
         },
         "TIMEOUT": 60*60*24*7,
     }
@@ -215,6 +219,66 @@ X_FRAME_OPTIONS = "DENY"
 # File upload settings
 MAX_FILE_UPLOAD_MB = 50
 QUOTA_STORAGE_BYTES_PER_USER = 100 * 1024 * 1024
+UPLOAD_CHUNK_MAX_BYTES = 64 * 1024 * 1024
+UPLOAD_SESSION_TTL_HOURS = 24
+PURGE_BATCH_SIZE = 500
+PURGE_UNLINK_WORKERS = 8
+BULK_MAX_FILES = 10_000
+
+# Request metrics: every request is logged as JSON, slow ones with their queries
+SLOW_REQUEST_MS = int(env("SLOW_REQUEST_MS", 500))
+SLOW_REQUEST_MAX_QUERIES = 200
+# Bearer token for the Prometheus /metrics endpoint; the endpoint is disabled when empty
+METRICS_TOKEN = env("METRICS_TOKEN", "")
+# "redis" sums metrics from every worker process in the default cache's Redis; "local" keeps them per process
+METRICS_STORE = env("METRICS_STORE", "redis")
+
+# Media bytes are handed to nginx via X-Accel-Redirect; set to false to stream from Django
+SERVE_MEDIA_WITH_NGINX = env("SERVE_MEDIA_WITH_NGINX", "true").lower() == "true"
+
+# API responses link media through expiring signed URLs that skip the session and the database.
+# In "nginx" mode nginx's secure_link module checks them and Django is not involved at all.
+SIGNED_URL_MODE = env("SIGNED_URL_MODE", "django")
+SIGNED_URL_SECRET = env("SIGNED_URL_SECRET", "")
+SIGNED_URL_TTL = 30 * 60
+
+# Route download, preview and public-link requests to async views; enable when serving cloud.asgi
+ASYNC_MEDIA_VIEWS = env("ASYNC_MEDIA_VIEWS", "false").lower() == "true"
+
+# Serialized file and folder list items are cached under keys that change with updated_at / version
+SERIALIZER_CACHE_TIMEOUT = 60 * 60
+
+# Sync clients page through changes?since=<token>; deletions are remembered this long,
+# after which older tokens get 410 Gone and the client must list everything again
+CHANGES_PAGE_SIZE = 1000
+CHANGES_TOMBSTONE_RETENTION = timedelta(days=30)
+
+# Public shared-link resolution is cached per token for at most this many seconds
+SHARED_LINK_CACHE_TIMEOUT = 5 * 60
+
+# Preview renditions, generated on first request and cached on disk
+PREVIEW_RENDITIONS = {
+    "icon": (64, 64),
+    "grid": (300, 300),
+    "lightbox": (1600, 1600),
+}
+PREVIEW_RENDITION_QUALITY = 80
+PREVIEW_MAX_PIXELS = 100_000_000
+PREVIEW_REDUCING_GAP = 2.0
+PREVIEW_THREADS = 4
+# Files per generate_previews task. The queue's soft time limit covers the whole batch,
+# so each video gets a task of its own.
+PREVIEW_BATCH_SIZES = {"image": 50, "video": 1}
+PREVIEW_DEDUP_TIMEOUT = 15 * 60
+
+# Video previews: ffprobe/ffmpeg run as subprocesses under these limits
+VIDEO_PROBE_TIMEOUT = 30
+VIDEO_FFMPEG_TIMEOUT = 120
+VIDEO_MEMORY_LIMIT_BYTES = 2 * 1024 * 1024 * 1024
+VIDEO_POSTER_MAX_SEEK = 10
+VIDEO_SPRITES = True
+VIDEO_SPRITE_GRID = (5, 5)
+VIDEO_SPRITE_TILE_WIDTH = 160
 ALLOWED_FILE_MIME_TYPES = [
     "image/jpeg",
     "image/png",
@@ -245,6 +309,32 @@ CELERY_WORKER_CONCURRENCY = int(env("CELERY_WORKER_CONCURRENCY", default=1)) or
 CELERY_WORKER_MAX_TASKS_PER_CHILD = int(env("CELERY_WORKER_MAX_TASKS_PER_CHILD", 1000))
 CELERY_WORKER_SEND_TASK_EVENTS = env("CELERY_WORKER_SEND_TASK_EVENTS", "true")
 
+# Queues: image thumbnails must not wait behind ffmpeg jobs or trash purges.
+CELERY_TASK_DEFAULT_QUEUE = "default"
+CELERY_TASK_QUEUE_MAX_PRIORITY = 10
+CELERY_TASK_DEFAULT_PRIORITY = 5
+CELERY_TASK_QUEUES = (
+    Queue("default", queue_arguments={"x-max-priority": CELERY_TASK_QUEUE_MAX_PRIORITY}),
+    Queue("previews.image", queue_arguments={"x-max-priority": CELERY_TASK_QUEUE_MAX_PRIORITY}),
+    Queue("previews.video", queue_arguments={"x-max-priority": CELERY_TASK_QUEUE_MAX_PRIORITY}),
+    Queue("maintenance"),
+)
+CELERY_TASK_ROUTES = {
+    "cloud.tasks.generate_preview": {"queue": "previews.image"},
+    "cloud.tasks.generate_previews": {"queue": "previews.image"},
+    "cloud.tasks.delete_old_files": {"queue": "maintenance"},
+    "cloud.tasks.delete_stale_upload_sessions": {"queue": "maintenance"},
+    "cloud.tasks.prune_tombstones": {"queue": "maintenance"},
+}
+PREVIEW_QUEUES = {
+    "image": {"queue": "previews.image", "soft_time_limit": 60, "time_limit": 90},
+    "video": {"queue": "previews.video", "soft_time_limit": 600, "time_limit": 660},
+}
+PREVIEW_PRIORITY_INTERACTIVE = 9
+PREVIEW_PRIORITY_BULK = 4
+MAINTENANCE_SOFT_TIME_LIMIT = 60 * 60
+MAINTENANCE_TIME_LIMIT = 60 * 60 + 300
+
 CELERY_EVENT_QUEUE_EXPIRES = float(env("CELERY_EVENT_QUEUE_EXPIRES", 60.0))
 CELERY_EVENT_QUEUE_TTL = float(env("CELERY_EVENT_QUEUE_TTL", 5.0))
 
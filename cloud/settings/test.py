@@ -56,10 +56,11 @@ CSRF_TRUSTED_ORIGINS = []
 
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "BACKEND": "cloud.metrics.InstrumentedLocMemCache",
         "LOCATION": "unique-test",
     }
 }
+METRICS_STORE = "local"
 
 ALLOWED_FILE_MIME_TYPE = [
     "image/png",
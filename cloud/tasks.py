@@ -1,54 +1,267 @@
+import functools
 import io
+import logging
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
-from django.core.files import File as DjangoFile
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
 from django.utils import timezone
 
-import ffmpeg
 from celery import shared_task
-from PIL import Image
+from celery.backends.base import DisabledBackend
+from celery.exceptions import SoftTimeLimitExceeded
 
-from cloud.filesystem.models import File
+from cloud import video
+from cloud.filesystem.models import RESTORE_WINDOW, ChangeSequence, File, Tombstone, UploadSession
+from cloud.previews import ImageTooLargeError, open_thumbnail
 
 
-@shared_task
-def generate_preview(file_id):
-    file = File.objects.get(pk=file_id)
+logger = logging.getLogger(__name__)
+
+VIDEO_FIELDS = ["duration_ms", "width", "height", "video_codec"]
+
+
+def render_preview(file):
     orig_path = file.file.path
     if file.mime_type.startswith("image/"):
-        image = Image.open(orig_path)
-        if image.mode != "RGB":
-            image = image.convert("RGB")
-        image.thumbnail((300, 300))
+        try:
+            image = open_thumbnail(orig_path, (300, 300))
+        except ImageTooLargeError:
+            logger.warning("generate_preview: %s is too large to preview", file.pk)
+            return None
         buf = io.BytesIO()
         image.save(buf, format="JPEG")
-        buf.seek(0)
-        file.preview_image.save(f"{file.id}.jpg", DjangoFile(buf), save=True)
-    elif file.mime_type.startswith("video/"):
-        process = (
-            ffmpeg
-            .input(orig_path, ss=0.5)
-            .filter("scale", 300, -1)
-            .output("pipe:", vframes=1, format="image2", vcodec="mjpeg")
-            .run(capture_stdout=True, capture_stderr=True)
-        )
-        stdout, _ = process
-        buf = io.BytesIO(stdout)
-        file.preview_image.save(f"{file.id}.jpg", DjangoFile(buf), save=True)
+        return buf.getvalue()
+    if file.mime_type.startswith("video/"):
+        poster = video.poster(orig_path, file.duration_ms)
+        if settings.VIDEO_SPRITES:
+            # Best effort: a failed sprite must not cost the poster.
+            try:
+                video.sprite(file, file.duration_ms)
+            except video.VideoError:
+                logger.warning("render_preview: could not build a sprite for %s", file.pk, exc_info=True)
+        return poster
+    return None
+
+
+def describe_video(file):
+    if file.duration_ms is not None:
+        return
+    try:
+        metadata = video.probe(file.file.path)
+    except (video.VideoError, ValueError):
+        logger.warning("generate_preview: could not probe %s", file.pk, exc_info=True)
+        return
+    for field, value in metadata.items():
+        setattr(file, field, value)
+
+
+def existing_previews(files):
+    blob_ids = {file.blob_id for file in files if file.blob_id is not None}
+    if not blob_ids:
+        return {}
+    return dict(
+        File.objects.filter(blob_id__in=blob_ids)
+        .exclude(preview_image="")
+        .exclude(preview_image__isnull=True)
+        .values_list("blob_id", "preview_image")
+    )
+
+
+def preview_content(file, existing):
+    if file.mime_type.startswith("video/"):
+        describe_video(file)
+    name = existing.get(file.blob_id)
+    if name:
+        with default_storage.open(name, "rb") as preview:
+            return preview.read()
+    return render_preview(file)
+
+
+@shared_task
+def generate_preview(file_id):
+    """Left for messages queued before generate_previews; renders nothing itself.
+
+    The file is queued again on its kind's queue, so video work never runs under the
+    image queue's limits.
+    """
+    queue_previews(File.objects.filter(pk=file_id))
 
 
 @shared_task
-def delete_old_files():
-    old_files = File.objects.filter(
-        deleted_at__isnull=False,
-        deleted_at__lt=timezone.now() - timedelta(days=30)
+def generate_previews(file_ids):
+    try:
+        return save_previews(file_ids)
+    finally:
+        # Also after a failure or the soft time limit, so the files can be queued again.
+        cache.delete_many([f"preview:queued:{file_id}" for file_id in file_ids])
+
+
+def save_previews(file_ids):
+    files = [
+        file for file in File.objects.in_bulk(file_ids).values()
+        if file.mime_type.startswith(("image/", "video/"))
+    ]
+    existing = existing_previews(files)
+
+    def safe_content(file):
+        try:
+            return preview_content(file, existing)
+        except SoftTimeLimitExceeded:
+            raise
+        except Exception:
+            logger.exception("generate_previews: failed to render %s", file.pk)
+            return None
+
+    images = [file for file in files if file.mime_type.startswith("image/")]
+    videos = [file for file in files if file.mime_type.startswith("video/")]
+    # Pillow releases the GIL while decoding, so images render in parallel threads.
+    with ThreadPoolExecutor(max_workers=settings.PREVIEW_THREADS) as pool:
+        contents = list(zip(images, pool.map(safe_content, images), strict=True))
+    contents.extend((file, safe_content(file)) for file in videos)
+
+    updated = []
+    for file, content in contents:
+        if content:
+            file.preview_image.save(f"{file.id}.jpg", ContentFile(content), save=False)
+            updated.append(file)
+    described = [file for file in videos if file.duration_ms is not None]
+    # bulk_update() skips auto_now and save(), so updated_at (which keys cached
+    # representations) and the sync change_seq are set here.
+    now = timezone.now()
+    changed = (*updated, *described)
+    with transaction.atomic():
+        # Rows before the change sequence, the order every writer locks in.
+        File.objects.select_for_update().filter(pk__in=[file.pk for file in changed]).exists()
+        seqs = {owner_id: ChangeSequence.advance(owner_id) for owner_id in sorted({file.owner_id for file in changed})}
+        for file in changed:
+            file.updated_at = now
+            file.change_seq = seqs[file.owner_id]
+        File.objects.bulk_update(updated, ["preview_image", "updated_at", "change_seq"])
+        File.objects.bulk_update(described, [*VIDEO_FIELDS, "updated_at", "change_seq"])
+    return len(updated)
+
+
+class PreviewOutbox:
+    """Collects preview requests for the current transaction and sends them once it commits."""
+
+    def __init__(self):
+        self.files = {}
+
+    @classmethod
+    def current(cls):
+        connection = transaction.get_connection()
+        outbox = getattr(connection, "preview_outbox", None)
+        # A rolled back transaction drops its flush callback, which is then collected.
+        if outbox is None or outbox.callback() is None:
+            outbox = connection.preview_outbox = cls()
+            callback = functools.partial(outbox.flush_on_commit, connection)
+            outbox.callback = weakref.ref(callback)
+            transaction.on_commit(callback, robust=True)
+        return outbox
+
+    def flush_on_commit(self, connection):
+        if getattr(connection, "preview_outbox", None) is self:
+            connection.preview_outbox = None
+        self.flush()
+
+    def add(self, file_id, kind, priority):
+        _, queued_priority = self.files.get(file_id, (kind, 0))
+        self.files[file_id] = (kind, max(priority, queued_priority))
+
+    def flush(self):
+        files, self.files = self.files, {}
+        # cache.add() is atomic, so of concurrent flushes only one claims each file.
+        files = {
+            file_id: value for file_id, value in files.items()
+            if cache.add(f"preview:queued:{file_id}", 1, timeout=settings.PREVIEW_DEDUP_TIMEOUT)
+        }
+        if not files:
+            return
+
+        batches = {}
+        for file_id, (kind, priority) in files.items():
+            batches.setdefault((kind, priority), []).append(file_id)
+        with generate_previews.app.producer_or_acquire() as producer:
+            for (kind, priority), file_ids in batches.items():
+                size = settings.PREVIEW_BATCH_SIZES[kind]
+                for start in range(0, len(file_ids), size):
+                    generate_previews.apply_async(
+                        args=[file_ids[start:start + size]],
+                        priority=priority,
+                        producer=producer,
+                        **settings.PREVIEW_QUEUES[kind],
+                    )
+
+
+def queue_previews(files, interactive=False):
+    priority = settings.PREVIEW_PRIORITY_INTERACTIVE if interactive else settings.PREVIEW_PRIORITY_BULK
+    in_transaction = transaction.get_connection().in_atomic_block
+    outbox = PreviewOutbox.current() if in_transaction else PreviewOutbox()
+    for file in files:
+        kind = file.mime_type.split("/", 1)[0]
+        if kind in settings.PREVIEW_QUEUES:
+            outbox.add(str(file.pk), kind, priority)
+    if not in_transaction:
+        outbox.flush()
+
+
+@shared_task(
+    bind=True,
+    soft_time_limit=settings.MAINTENANCE_SOFT_TIME_LIMIT,
+    time_limit=settings.MAINTENANCE_TIME_LIMIT,
+)
+def delete_old_files(self):
+    cutoff = timezone.now() - RESTORE_WINDOW
+    expired = File.objects.filter(deleted_at__isnull=False, deleted_at__lt=cutoff)
+    purged = 0
+
+    try:
+        while True:
+            with transaction.atomic():
+                ids = list(
+                    expired.select_for_update(skip_locked=True)
+                    .order_by("deleted_at")
+                    .values_list("id", flat=True)[:settings.PURGE_BATCH_SIZE]
+                )
+                if not ids:
+                    break
+                purged += File.objects.filter(pk__in=ids).purge()
+
+            logger.info("delete_old_files: purged %s files", purged)
+            if self.request.id and not isinstance(self.backend, DisabledBackend):
+                self.update_state(state="PROGRESS", meta={"purged": purged})
+    except SoftTimeLimitExceeded:
+        logger.warning("delete_old_files: time limit reached after %s files, the next run resumes", purged)
+
+    return purged
+
+
+@shared_task(
+    soft_time_limit=settings.MAINTENANCE_SOFT_TIME_LIMIT,
+    time_limit=settings.MAINTENANCE_TIME_LIMIT,
+)
+def delete_stale_upload_sessions():
+    stale_sessions = UploadSession.objects.filter(
+        updated_at__lt=timezone.now() - timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
     )
 
-    for file_obj in old_files:
-        if file_obj.file:
-            file_obj.file.delete(save=False)
-        if file_obj.preview_image:
-            file_obj.preview_image.delete(save=False)
-        file_obj.delete()
-        
-    
+    for session in stale_sessions:
+        if default_storage.exists(session.path):
+            default_storage.delete(session.path)
+        session.delete()
+
+
+@shared_task(
+    soft_time_limit=settings.MAINTENANCE_SOFT_TIME_LIMIT,
+    time_limit=settings.MAINTENANCE_TIME_LIMIT,
+)
+def prune_tombstones():
+    pruned = Tombstone.prune(timezone.now() - settings.CHANGES_TOMBSTONE_RETENTION)
+    logger.info("prune_tombstones: pruned %s tombstones", pruned)
+    return pruned
@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import include, path, reverse
+from django.utils import timezone
+
+from cloud import metrics
+from cloud.filesystem.models import File, SharedLink
+from cloud.filesystem.urls import async_urlpatterns
+
+
+urlpatterns = [
+    path("api/", include(async_urlpatterns)),
+    path("", include("cloud.urls")),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncMediaViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="password123")
+        self.other = User.objects.create_user(username="other", password="password123")
+        self.file = File.objects.create(
+            owner=self.user, name="file.txt", size=10, mime_type="text/plain", file="file.txt"
+        )
+        self.link = self.file.shared_links.create(
+            expires_at=timezone.now() + timedelta(minutes=60), max_downloads=2
+        )
+
+    async def test_download(self):
+        await self.async_client.aforce_login(self.user)
+        url = reverse("file-download", args=[self.file.id])
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], "/protected-media/file.txt")
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="file.txt"')
+
+        response = await self.async_client.get(url, headers={"If-None-Match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+    async def test_download_requires_owner(self):
+        url = reverse("file-download", args=[self.file.id])
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        await self.async_client.aforce_login(self.other)
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(SERVE_MEDIA_WITH_NGINX=False)
+    async def test_download_range_without_nginx(self):
+        with open(os.path.join(settings.MEDIA_ROOT, "file.txt"), "wb") as f:
+            f.write(b"0123456789")
+        await self.async_client.aforce_login(self.user)
+        url = reverse("file-download", args=[self.file.id])
+        response = await self.async_client.get(url, headers={"Range": "bytes=2-5"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), b"2345")
+
+    async def test_preview(self):
+        await self.async_client.aforce_login(self.user)
+        url = reverse("file-preview", args=[self.file.id])
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+        response = await self.async_client.get(url, {"size": "huge"})
+        self.assertEqual(response.status_code, 400)
+
+        self.file.preview_image = "previews/file.jpg"
+        await self.file.asave(update_fields=["preview_image"])
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertIn("Accept", response["Vary"])
+
+    async def test_public_file_counts_downloads(self):
+        await self.async_client.aforce_login(self.other)
+        url = reverse("public-file", args=[self.link.token])
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        response = await self.async_client.get(url, headers={"If-None-Match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+        statuses = [(await self.async_client.get(url)).status_code for _ in range(2)]
+        self.assertEqual(statuses, [200, 404])
+        link = await SharedLink.objects.aget(pk=self.link.pk)
+        self.assertEqual(link.download_count, 2)
+
+    @mock.patch.dict(connection.settings_dict, {"ATOMIC_REQUESTS": True})
+    async def test_atomic_requests(self):
+        await self.async_client.aforce_login(self.user)
+        urls = [
+            reverse("file-download", args=[self.file.id]),
+            reverse("file-preview", args=[self.file.id]),
+            reverse("public-file", args=[self.link.token]),
+        ]
+        statuses = [(await self.async_client.get(url)).status_code for url in urls]
+        self.assertEqual(statuses, [200, 404, 200])
+
+    async def test_public_file_exhausted_link_refuses_ranges(self):
+        await SharedLink.objects.filter(pk=self.link.pk).aupdate(download_count=2)
+        await self.async_client.aforce_login(self.other)
+        url = reverse("public-file", args=[self.link.token])
+        for header in ("bytes=-100000", "bytes=1-"):
+            response = await self.async_client.get(url, headers={"Range": header})
+            self.assertEqual(response.status_code, 404)
+
+    async def test_public_file_unknown_token(self):
+        token = str(uuid.uuid4())
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse("public-file", args=[token]))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(await cache.aget(SharedLink.cache_key(token)), {})
+
+    async def test_queries_are_logged(self):
+        await self.async_client.aforce_login(self.user)
+        with self.assertLogs("json", "INFO") as logs:
+            await self.async_client.get(reverse("file-download", args=[self.file.id]))
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line["view"], "file-download")
+        self.assertGreater(line["db_queries"], 0)
+        self.assertGreater(line["cache_hits"], 0)
+
+    async def test_metrics_are_recorded_off_the_event_loop(self):
+        await self.async_client.aforce_login(self.user)
+        threads = []
+        with mock.patch.object(metrics.registry, "add", side_effect=lambda *samples: threads.append(threading.get_ident())):
+            await self.async_client.get(reverse("file-download", args=[self.file.id]))
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
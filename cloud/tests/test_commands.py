@@ -0,0 +1,34 @@
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from cloud.filesystem.models import File, StorageUsage
+
+
+class RebuildStorageUsageCommandTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password123")
+        File.objects.create(owner=self.user, name="a.txt", size=10, mime_type="text/plain", file="a.txt")
+        File.objects.create(
+            owner=self.user,
+            name="b.txt",
+            size=5,
+            mime_type="text/plain",
+            file="b.txt",
+            deleted_at=timezone.now(),
+        )
+
+    def test_rebuild_fixes_drift(self):
+        StorageUsage.objects.create(user=self.user, used_bytes=999, trash_bytes=0)
+        call_command("rebuild_storage_usage", stdout=StringIO())
+        usage = StorageUsage.objects.get(user=self.user)
+        self.assertEqual((usage.used_bytes, usage.trash_bytes), (10, 5))
+
+    def test_dry_run_does_not_write(self):
+        out = StringIO()
+        call_command("rebuild_storage_usage", "--dry-run", stdout=out)
+        self.assertFalse(StorageUsage.objects.filter(user=self.user).exists())
+        self.assertIn("1 counters out of date", out.getvalue())
@@ -0,0 +1,79 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework.test import APIClient
+
+from cloud.filesystem.models import File, Folder
+
+
+class FileIndexUsageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password123")
+        self.client = APIClient()
+        self.client.login(username="testuser", password="password123")
+        self.folder = Folder.objects.create(owner=self.user, name="folder")
+
+        other = User.objects.create_user(username="other", password="password123")
+        deleted_at = timezone.now() - timedelta(days=40)
+        File.objects.bulk_create(
+            File(
+                owner=owner,
+                name=f"{i}.txt",
+                size=1,
+                mime_type="text/plain",
+                file="f.txt",
+                folder=self.folder if i % 2 else None,
+                deleted_at=deleted_at if i % 3 == 0 else None,
+            )
+            for owner in (self.user, other)
+            for i in range(200)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute(f"EXPLAIN {sql}")
+            else:
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+            return "\n".join(str(row) for row in cursor.fetchall())
+
+    def assert_endpoint_uses_index(self, url, index_name):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        plans = [
+            self.explain(query["sql"])
+            for query in ctx.captured_queries
+            if query["sql"].startswith("SELECT") and '"filesystem_file"' in query["sql"]
+        ]
+        self.assertTrue(plans)
+        self.assertTrue(any(index_name in plan for plan in plans), "\n\n".join(plans))
+
+    def test_file_list_uses_live_index(self):
+        self.assert_endpoint_uses_index(reverse("file-list"), "file_live_uploaded_idx")
+
+    def test_trash_uses_trash_index(self):
+        self.assert_endpoint_uses_index(reverse("file-trash"), "file_trash_idx")
+
+    def test_folder_content_uses_folder_index(self):
+        self.assert_endpoint_uses_index(
+            reverse("folder-content", args=[self.folder.id]), "file_live_folder_idx"
+        )
+
+    def test_purge_scan_uses_purge_index(self):
+        queryset = File.objects.filter(
+            deleted_at__isnull=False, deleted_at__lt=timezone.now() - timedelta(days=30)
+        )
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        self.assertIn("file_trash_purge_idx", queryset.explain())
@@ -0,0 +1,66 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from cloud.filesystem.models import File
+from cloud.metrics import registry
+
+
+class RequestMetricsMiddlewareTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        registry.clear()
+        self.user = User.objects.create_user(username="testuser", password="password123")
+        self.client = APIClient()
+        self.client.login(username="testuser", password="password123")
+        self.file = File.objects.create(
+            owner=self.user, name="file.txt", size=10, mime_type="text/plain", file="file.txt"
+        )
+
+    def get_logged(self, url, level="INFO"):
+        with self.assertLogs("json", level) as logs:
+            self.client.get(url)
+        return json.loads(logs.records[-1].getMessage())
+
+    def test_logs_request_as_json(self):
+        line = self.get_logged(reverse("file-list"))
+        self.assertEqual(line["event"], "request")
+        self.assertEqual(line["view"], "file-list")
+        self.assertEqual(line["status"], 200)
+        self.assertGreater(line["db_queries"], 0)
+        self.assertGreater(line["response_bytes"], 0)
+        self.assertNotIn("queries", line)
+
+    @override_settings(SLOW_REQUEST_MS=0)
+    def test_slow_request_logs_queries(self):
+        line = self.get_logged(reverse("file-list"), level="WARNING")
+        self.assertEqual(line["event"], "slow_request")
+        self.assertEqual(len(line["queries"]), line["db_queries"])
+        self.assertTrue(any("filesystem_file" in query["sql"] for query in line["queries"]))
+
+    def test_counts_cache_hits_and_misses(self):
+        link = self.file.shared_links.create()
+        url = reverse("public-file", args=[link.token])
+        first = self.get_logged(url)
+        second = self.get_logged(url)
+        self.assertGreater(first["cache_misses"], second["cache_misses"])
+        self.assertGreater(second["cache_hits"], first["cache_hits"])
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_metrics_endpoint(self):
+        self.client.get(reverse("file-list"))
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+
+        response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        body = response.content.decode()
+        self.assertIn('cloud_http_requests_total{method="GET",status="200",view="file-list"} 1\n', body)
+        self.assertNotIn("pid=", body)
+        self.assertIn('cloud_http_request_duration_seconds_bucket{method="GET",view="file-list"', body)
+        self.assertNotIn('view="metrics"', body)
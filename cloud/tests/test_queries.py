@@ -0,0 +1,104 @@
+import re
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework.test import APIClient
+
+from cloud.filesystem.models import File, Folder, StorageUsage
+
+
+UPDATE_SET_RE = re.compile(r'^UPDATE "(\w+)" SET (.*?) WHERE', re.DOTALL)
+
+
+class WriteQueryTests(TestCase):
+    """Each mutation is pinned to a query budget and writes only the columns it changes."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password123")
+        self.client = APIClient()
+        self.client.login(username="testuser", password="password123")
+        self.folder = Folder.objects.create(owner=self.user, name="folder")
+        self.file = File.objects.create(
+            owner=self.user, name="file.txt", size=10, mime_type="text/plain", file="file.txt"
+        )
+        StorageUsage.for_user(self.user.id)
+
+    def request(self, method, url, queries, data=None, **kwargs):
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(url, data, **kwargs)
+        self.assertLess(response.status_code, 300, response.content)
+        self.assertEqual(len(ctx.captured_queries), queries, "\n".join(q["sql"] for q in ctx.captured_queries))
+        return response, [q["sql"] for q in ctx.captured_queries]
+
+    def updated_columns(self, statements, table):
+        columns = set()
+        for sql in statements:
+            match = UPDATE_SET_RE.match(sql)
+            if match and match.group(1) == table:
+                columns.update(re.findall(r'"(\w+)" = ', match.group(2)))
+        return columns
+
+    @mock.patch("cloud.filesystem.views.queue_previews")
+    def test_create_is_a_single_insert(self, queue_previews):
+        upload = SimpleUploadedFile("new.txt", b"new content", content_type="text/plain")
+        _, statements = self.request(
+            "post", reverse("file-list"), 18, {"file": upload, "folder": self.folder.id}, format="multipart"
+        )
+        inserts = [sql for sql in statements if sql.startswith('INSERT INTO "filesystem_file"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.updated_columns(statements, "filesystem_file"), set())
+
+    def test_partial_update(self):
+        _, statements = self.request(
+            "patch", reverse("file-detail", args=[self.file.id]), 6, {"name": "renamed.txt"}, format="json"
+        )
+        self.assertEqual(self.updated_columns(statements, "filesystem_file"), {"name", "updated_at", "change_seq"})
+
+    def test_move(self):
+        _, statements = self.request(
+            "post", reverse("file-move", args=[self.file.id]), 7, {"folder": self.folder.id}, format="json"
+        )
+        self.assertEqual(self.updated_columns(statements, "filesystem_file"), {"folder_id", "updated_at", "change_seq"})
+
+    def test_destroy(self):
+        _, statements = self.request("delete", reverse("file-detail", args=[self.file.id]), 9)
+        self.assertEqual(self.updated_columns(statements, "filesystem_file"), {"deleted_at", "updated_at", "change_seq"})
+
+    def test_restore(self):
+        File.objects.filter(pk=self.file.pk).update(deleted_at=timezone.now())
+        _, statements = self.request("post", reverse("file-restore", args=[self.file.id]), 13)
+        self.assertEqual(self.updated_columns(statements, "filesystem_file"), {"deleted_at", "updated_at", "change_seq"})
+
+    def test_permanent_delete(self):
+        File.objects.filter(pk=self.file.pk).update(deleted_at=timezone.now())
+        self.request("post", reverse("file-permanent-delete", args=[self.file.id]), 13)
+
+    def test_share(self):
+        self.request("post", reverse("file-share", args=[self.file.id]), 3, {"ttl_minutes": 5}, format="json")
+
+    def test_public_download_counts_with_one_update(self):
+        link = self.file.shared_links.create(max_downloads=3)
+        url = reverse("public-file", args=[link.token])
+        self.client.get(url)
+        _, statements = self.request("get", url, 2)
+        self.assertEqual(self.updated_columns(statements, "filesystem_sharedlink"), {"download_count"})
+
+    def test_folder_rename(self):
+        _, statements = self.request(
+            "patch", reverse("folder-detail", args=[self.folder.id]), 8, {"name": "renamed"}, format="json"
+        )
+        self.assertEqual(self.updated_columns(statements, "filesystem_folder"), {"name", "version", "change_seq"})
+
+    def test_folder_move(self):
+        target = Folder.objects.create(owner=self.user, name="target")
+        _, statements = self.request(
+            "patch", reverse("folder-detail", args=[self.folder.id]), 12, {"parent": target.id}, format="json"
+        )
+        self.assertEqual(self.updated_columns(statements, "filesystem_folder"), {"parent_id", "path", "version", "change_seq"})
@@ -1,16 +1,37 @@
+import contextlib
 import os
 import shutil
+import sys
 import unittest
+from datetime import timedelta
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase, override_settings
 from django.utils import timezone
 
+from celery.exceptions import SoftTimeLimitExceeded
 from PIL import Image
 
-from cloud.filesystem.models import File
-from cloud.tasks import generate_preview
+from cloud import video
+from cloud.filesystem.models import (
+    ChangeSequence,
+    File,
+    Folder,
+    SharedLink,
+    StorageUsage,
+    Tombstone,
+)
+from cloud.tasks import (
+    delete_old_files,
+    generate_preview,
+    generate_previews,
+    prune_tombstones,
+    queue_previews,
+)
 
 
 class GeneratePreviewTaskTests(TestCase):
@@ -48,14 +69,244 @@ class GeneratePreviewTaskTests(TestCase):
             )
 
     def test_generate_preview_image(self):
-        generate_preview(self.image_file.pk)
+        generate_previews([str(self.image_file.pk)])
         self.image_file.refresh_from_db()
         self.assertIsNotNone(self.image_file.preview_image)
         self.assertTrue(os.path.exists(self.image_file.preview_image.path))
 
+    def test_generate_preview_applies_exif_orientation(self):
+        image_path = os.path.join(settings.CONTENT_DIR, "rotated.jpg")
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        Image.new("RGB", (640, 480), color="red").save(image_path, exif=exif)
+        self.image_file.file = "content/rotated.jpg"
+        self.image_file.save()
+        generate_previews([str(self.image_file.pk)])
+        self.image_file.refresh_from_db()
+        with Image.open(self.image_file.preview_image.path) as preview:
+            self.assertEqual(preview.size, (225, 300))
+
+    @override_settings(PREVIEW_MAX_PIXELS=1000)
+    def test_generate_preview_skips_oversized_image(self):
+        generate_previews([str(self.image_file.pk)])
+        self.image_file.refresh_from_db()
+        self.assertFalse(self.image_file.preview_image)
+
     @unittest.skipUnless(shutil.which("ffmpeg"), "ffmpeg not installed")
     def test_generate_preview_video(self):
-        generate_preview(self.video_file.pk)
+        generate_previews([str(self.video_file.pk)])
         self.video_file.refresh_from_db()
         self.assertIsNotNone(self.video_file.preview_image)
         self.assertTrue(os.path.exists(self.video_file.preview_image.path))
+        self.assertEqual(self.video_file.width, 320)
+        self.assertEqual(self.video_file.duration_ms, 1000)
+
+    @mock.patch("cloud.video.sprite")
+    @mock.patch("cloud.video.poster", return_value=b"jpeg")
+    @mock.patch("cloud.video.probe")
+    def test_generate_preview_video_stores_metadata(self, probe, poster, sprite):
+        probe.return_value = {"duration_ms": 4000, "width": 1920, "height": 1080, "video_codec": "h264"}
+        video_file = File.objects.create(
+            owner=self.user, name="clip.mp4", mime_type="video/mp4", size=1, file="content/clip.mp4"
+        )
+        generate_previews([str(video_file.pk)])
+        video_file.refresh_from_db()
+        self.assertEqual((video_file.width, video_file.height, video_file.video_codec), (1920, 1080, "h264"))
+        self.assertEqual(video_file.duration_ms, 4000)
+        self.assertTrue(video_file.preview_image)
+        poster.assert_called_once_with(video_file.file.path, 4000)
+        sprite.assert_called_once()
+
+        generate_previews([str(video_file.pk)])
+        probe.assert_called_once()
+
+    @mock.patch("cloud.video.sprite", side_effect=video.VideoError("timed out"))
+    @mock.patch("cloud.video.poster", return_value=b"jpeg")
+    @mock.patch("cloud.video.probe", return_value={"duration_ms": 4000})
+    def test_generate_preview_keeps_poster_when_sprite_fails(self, probe, poster, sprite):
+        video_file = File.objects.create(
+            owner=self.user, name="clip.mp4", mime_type="video/mp4", size=1, file="content/clip.mp4"
+        )
+        with self.assertLogs("cloud.tasks", "WARNING"):
+            generate_previews([str(video_file.pk)])
+        video_file.refresh_from_db()
+        self.assertTrue(video_file.preview_image)
+
+
+class VideoRunTests(TestCase):
+    def test_run_times_out(self):
+        with self.assertRaisesRegex(video.VideoError, "timed out"):
+            video.run([sys.executable, "-c", "import time; time.sleep(5)"], timeout=0.2)
+
+    @override_settings(VIDEO_MEMORY_LIMIT_BYTES=256 * 1024 * 1024)
+    def test_run_enforces_memory_limit(self):
+        with self.assertRaises(video.VideoError):
+            video.run([sys.executable, "-c", "bytearray(512 * 1024 * 1024)"], timeout=10)
+        self.assertEqual(video.run([sys.executable, "-c", "print('ok')"], timeout=10), b"ok\n")
+
+
+class GeneratePreviewsTaskTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password123")
+        os.makedirs(settings.CONTENT_DIR, exist_ok=True)
+        self.images = []
+        for i in range(3):
+            name = f"content/batch_{i}.png"
+            Image.new("RGB", (400, 200), color="blue").save(os.path.join(settings.MEDIA_ROOT, name))
+            self.images.append(
+                File.objects.create(
+                    owner=self.user, name=name, mime_type="image/png", size=1, file=name
+                )
+            )
+        self.text = File.objects.create(
+            owner=self.user, name="notes.txt", mime_type="text/plain", size=1, file="content/notes.txt"
+        )
+
+    def test_generate_previews_batches_queries(self):
+        file_ids = [str(f.pk) for f in [*self.images, self.text]]
+        with self.assertNumQueries(7):
+            generated = generate_previews(file_ids)
+        self.assertEqual(generated, 3)
+        for image_file in self.images:
+            image_file.refresh_from_db()
+            with Image.open(image_file.preview_image.path) as preview:
+                self.assertEqual(preview.size, (300, 150))
+        self.text.refresh_from_db()
+        self.assertFalse(self.text.preview_image)
+
+
+    @mock.patch("cloud.tasks.preview_content", side_effect=SoftTimeLimitExceeded)
+    def test_generate_previews_releases_dedup_keys_on_time_limit(self, preview_content):
+        file_ids = [str(f.pk) for f in self.images]
+        cache.set_many({f"preview:queued:{file_id}": 1 for file_id in file_ids})
+        with self.assertRaises(SoftTimeLimitExceeded):
+            generate_previews(file_ids)
+        self.assertEqual(cache.get_many([f"preview:queued:{file_id}" for file_id in file_ids]), {})
+
+class QueuePreviewsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password123")
+        cache.clear()
+
+    def make_files(self, mime_type, count):
+        return [
+            File(owner=self.user, name="f", size=1, mime_type=mime_type, file="f") for _ in range(count)
+        ]
+
+    @override_settings(PREVIEW_BATCH_SIZES={"image": 2, "video": 1})
+    @mock.patch("cloud.tasks.generate_previews.apply_async")
+    def test_routes_by_media_type(self, apply_async):
+        files = self.make_files("image/png", 3) + self.make_files("video/mp4", 2) + self.make_files("text/plain", 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            queue_previews(files)
+        queues = [call.kwargs["queue"] for call in apply_async.call_args_list]
+        self.assertEqual(queues, ["previews.image", "previews.image", "previews.video", "previews.video"])
+        self.assertEqual([len(call.kwargs["args"][0]) for call in apply_async.call_args_list], [2, 1, 1, 1])
+        self.assertEqual(apply_async.call_args_list[2].kwargs["soft_time_limit"], 600)
+
+    @mock.patch("cloud.tasks.generate_previews.apply_async")
+    def test_legacy_single_file_task_requeues_by_kind(self, apply_async):
+        video_file = File.objects.create(owner=self.user, name="v", size=1, mime_type="video/mp4", file="v")
+        with self.captureOnCommitCallbacks(execute=True):
+            generate_preview(video_file.pk)
+        apply_async.assert_called_once()
+        self.assertEqual(apply_async.call_args.kwargs["queue"], "previews.video")
+        self.assertEqual(apply_async.call_args.kwargs["args"], [[str(video_file.pk)]])
+
+    @mock.patch("cloud.tasks.generate_previews.apply_async")
+    def test_dispatches_only_after_commit(self, apply_async):
+        with self.captureOnCommitCallbacks() as callbacks:
+            queue_previews(self.make_files("image/png", 1))
+            apply_async.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+
+    @mock.patch("cloud.tasks.generate_previews.apply_async")
+    def test_collapses_duplicates_into_one_dispatch(self, apply_async):
+        files = self.make_files("image/png", 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            queue_previews(files)
+            queue_previews(files[:1], interactive=True)
+        self.assertEqual(apply_async.call_count, 2)
+        dispatched = [file_id for call in apply_async.call_args_list for file_id in call.kwargs["args"][0]]
+        self.assertCountEqual(dispatched, [str(f.pk) for f in files])
+        interactive = [call for call in apply_async.call_args_list if str(files[0].pk) in call.kwargs["args"][0]]
+        self.assertEqual(interactive[0].kwargs["priority"], settings.PREVIEW_PRIORITY_INTERACTIVE)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            queue_previews(files)
+        self.assertEqual(apply_async.call_count, 2)
+
+    @mock.patch("cloud.tasks.generate_previews.apply_async")
+    def test_rolled_back_requests_are_dropped(self, apply_async):
+        rolled_back, committed = self.make_files("image/png", 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            with contextlib.suppress(RuntimeError), transaction.atomic():
+                queue_previews([rolled_back])
+                raise RuntimeError
+            queue_previews([committed])
+        self.assertEqual([call.kwargs["args"][0] for call in apply_async.call_args_list], [[str(committed.pk)]])
+
+
+class DeleteOldFilesTaskTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password123")
+        os.makedirs(settings.CONTENT_DIR, exist_ok=True)
+        expired_at = timezone.now() - timedelta(days=31)
+        self.paths = []
+        self.expired = []
+        for i in range(5):
+            name = f"content/expired_{i}.txt"
+            path = os.path.join(settings.MEDIA_ROOT, name)
+            with open(path, "wb") as f:
+                f.write(b"x")
+            self.paths.append(path)
+            file_obj = File.objects.create(
+                owner=self.user,
+                name=f"expired_{i}.txt",
+                size=1,
+                mime_type="text/plain",
+                file=name,
+                deleted_at=expired_at,
+            )
+            file_obj.shared_links.create()
+            self.expired.append(file_obj)
+        self.recent = File.objects.create(
+            owner=self.user,
+            name="recent.txt",
+            size=1,
+            mime_type="text/plain",
+            file="content/recent.txt",
+            deleted_at=timezone.now(),
+        )
+        StorageUsage.for_user(self.user.id)
+
+    @override_settings(PURGE_BATCH_SIZE=2)
+    def test_delete_old_files_purges_in_batches(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            purged = delete_old_files()
+        self.assertEqual(purged, 5)
+        self.assertFalse(File.objects.filter(pk__in=[f.pk for f in self.expired]).exists())
+        self.assertFalse(SharedLink.objects.exists())
+        self.assertTrue(File.objects.filter(pk=self.recent.pk).exists())
+        for path in self.paths:
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(StorageUsage.objects.get(user=self.user).trash_bytes, 1)
+
+    def test_delete_old_files_is_idempotent(self):
+        delete_old_files()
+        self.assertEqual(delete_old_files(), 0)
+
+
+class PruneTombstonesTaskTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password123")
+
+    def test_prune_tombstones_raises_pruned_seq(self):
+        folder = Folder.objects.create(owner=self.user, name="old")
+        Tombstone.record(Tombstone.FOLDER, self.user.id, [folder.id], ChangeSequence.advance(self.user.id))
+        Tombstone.objects.update(created_at=timezone.now() - timedelta(days=31))
+        Tombstone.record(Tombstone.FOLDER, self.user.id, [folder.id + 1], ChangeSequence.advance(self.user.id))
+
+        self.assertEqual(prune_tombstones(), 1)
+        self.assertEqual(Tombstone.objects.count(), 1)
+        self.assertEqual(ChangeSequence.current(self.user.id).pruned_seq, 2)
@@ -1,18 +1,30 @@
+import base64
+import hashlib
+import io
+import json
 import os
+import time
+import uuid
+import zipfile
 from datetime import timedelta
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
 
 from PIL import Image
-from rest_framework.test import APIClient
+from rest_framework.test import APIClient, APIRequestFactory
 
-from cloud.filesystem.models import File, Folder
-from cloud.tasks import generate_preview
+from cloud.filesystem.models import Blob, File, Folder, StorageUsage, Tombstone, UploadSession
+from cloud.filesystem.serializers import FileSerializer, FolderSerializer
+from cloud.filesystem.views import FileViewSet
+from cloud.tasks import generate_previews
+from cloud.utils import blob_upload_path, rendition_upload_path
 
 
 class FileViewSetTests(TestCase):
@@ -35,7 +47,43 @@ class FileViewSetTests(TestCase):
         url = reverse("file-list")
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data[0]["name"], self.file.name)
+        self.assertEqual(response.data["results"][0]["name"], self.file.name)
+
+    def test_concurrent_deletes_count_usage_once(self):
+        usage = StorageUsage.for_user(self.user.id)
+        used, trash = usage.used_bytes, usage.trash_bytes
+        view = FileViewSet()
+        # Both requests loaded the live row before either trashed it.
+        view.perform_destroy(self.file)
+        view.perform_destroy(self.file)
+        usage.refresh_from_db()
+        self.assertEqual((usage.used_bytes, usage.trash_bytes), (used - 10, trash + 10))
+
+    def test_list_files_keyset_pagination(self):
+        same_time = timezone.now()
+        for i in range(4):
+            File.objects.create(
+                owner=self.user, name=f"page{i}.txt", size=1, mime_type="text/plain", file="f.txt"
+            )
+        File.objects.filter(owner=self.user).update(uploaded_at=same_time)
+
+        url = reverse("file-list")
+        seen = []
+        response = self.client.get(url, {"page_size": 2})
+        while True:
+            self.assertLessEqual(len(response.data["results"]), 2)
+            seen.extend(item["id"] for item in response.data["results"])
+            if response.data["next"] is None:
+                break
+            response = self.client.get(response.data["next"])
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+        response = self.client.get(url, {"cursor": "garbage"})
+        self.assertEqual(response.status_code, 404)
+        cursor = base64.urlsafe_b64encode(json.dumps([timezone.now().isoformat(), "not-a-uuid"]).encode())
+        response = self.client.get(url, {"cursor": cursor.decode()})
+        self.assertEqual(response.status_code, 404)
 
     def test_create_file(self):
         url = reverse("file-list")
@@ -66,6 +114,31 @@ class FileViewSetTests(TestCase):
         self.assertEqual(response.status_code, 201)
         self.assertGreaterEqual(len(response.data), 1)
 
+    @mock.patch("cloud.filesystem.views.queue_previews")
+    def test_duplicate_uploads_share_blob(self, queue_previews_mock):
+        url = reverse("file-list")
+        ids = []
+        for name in ("a.txt", "b.txt"):
+            data = {"file": SimpleUploadedFile(name, b"same bytes", content_type="text/plain")}
+            ids.append(self.client.post(url, data, format="multipart").data["id"])
+        first, second = File.objects.get(pk=ids[0]), File.objects.get(pk=ids[1])
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(first.file.name, second.file.name)
+        blob = Blob.objects.get(pk=first.blob_id)
+        self.assertEqual(blob.ref_count, 2)
+        blob_path = blob.file.path
+
+        for file_obj in (first, second):
+            self.client.delete(reverse("file-detail", args=[file_obj.id]))
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse("file-permanent-delete", args=[file_obj.id]))
+            if file_obj is first:
+                blob.refresh_from_db()
+                self.assertEqual(blob.ref_count, 1)
+                self.assertTrue(os.path.exists(blob_path))
+        self.assertFalse(Blob.objects.filter(pk=blob.pk).exists())
+        self.assertFalse(os.path.exists(blob_path))
+
     def test_share_file(self):
         url = reverse("file-share", args=[self.file.id])
         response = self.client.post(url, {"ttl_minutes": 120, "max_downloads": 10})
@@ -79,6 +152,50 @@ class FileViewSetTests(TestCase):
         self.assertIn("X-Accel-Redirect", response)
         self.assertEqual(response["Content-Disposition"], 'attachment; filename="file.txt"')
 
+    def test_download_conditional(self):
+        url = reverse("file-download", args=[self.file.id])
+        response = self.client.get(url)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn("X-Accel-Redirect", response)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(response.status_code, 304)
+
+        self.file.updated_at = timezone.now() + timedelta(seconds=5)
+        self.file.save(update_fields=["updated_at"])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(SERVE_MEDIA_WITH_NGINX=False)
+    def test_download_ranges_without_nginx(self):
+        with open(os.path.join(settings.MEDIA_ROOT, "file.txt"), "wb") as f:
+            f.write(b"0123456789")
+        url = reverse("file-download", args=[self.file.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"0123456789")
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_RANGE="bytes=2-5", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 2-5/10")
+        self.assertNotIn("Content-Encoding", response)
+        self.assertEqual(b"".join(response.streaming_content), b"2345")
+
+        response = self.client.get(url, HTTP_RANGE="bytes=-3", HTTP_IF_RANGE=etag)
+        self.assertEqual(b"".join(response.streaming_content), b"789")
+
+        response = self.client.get(url, HTTP_RANGE="bytes=2-5", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+        response = self.client.get(url, HTTP_RANGE="bytes=20-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */10")
+
     def test_preview_without_preview(self):
         url = reverse("file-preview", args=[self.file.id])
         response = self.client.get(url)
@@ -96,7 +213,7 @@ class FileViewSetTests(TestCase):
             file="content/preview_test.jpg",
             folder=self.folder,
         )
-        generate_preview(image_file.pk)
+        generate_previews([str(image_file.pk)])
         image_file.refresh_from_db()
         self.assertIsNotNone(image_file.preview_image)
         url = reverse("file-preview", args=[image_file.id])
@@ -104,6 +221,129 @@ class FileViewSetTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn("X-Accel-Redirect", response)
         self.assertEqual(response["Content-Type"], "image/jpeg")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["Cache-Control"], "private, max-age=3600")
+
+    def test_preview_rendition_negotiates_format_and_is_cached(self):
+        image_path = os.path.join(settings.CONTENT_DIR, "rendition_test.png")
+        Image.new("RGB", (800, 600), color="green").save(image_path)
+        image_file = File.objects.create(
+            owner=self.user,
+            name="rendition_test.png",
+            mime_type="image/png",
+            size=os.path.getsize(image_path),
+            file="content/rendition_test.png",
+        )
+        url = reverse("file-preview", args=[image_file.id])
+        response = self.client.get(url, {"size": "icon"}, HTTP_ACCEPT="image/webp,image/*")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertIn("Accept", response["Vary"])
+        rendition_path = os.path.join(
+            settings.MEDIA_ROOT, response["X-Accel-Redirect"].removeprefix("/protected-media/")
+        )
+        with Image.open(rendition_path) as rendition:
+            self.assertEqual(rendition.size, (64, 48))
+        mtime = os.path.getmtime(rendition_path)
+
+        response = self.client.get(url, {"size": "icon"}, HTTP_ACCEPT="image/webp")
+        self.assertEqual(os.path.getmtime(rendition_path), mtime)
+
+        response = self.client.get(url, {"size": "icon"}, HTTP_ACCEPT="image/*")
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+
+        response = self.client.get(url, {"size": "huge"})
+        self.assertEqual(response.status_code, 400)
+
+        image_file.deleted_at = timezone.now()
+        image_file.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("file-permanent-delete", args=[image_file.id]))
+        self.assertFalse(os.path.exists(os.path.dirname(rendition_path)))
+
+    def test_preview_rendition_of_corrupt_image(self):
+        with open(os.path.join(settings.CONTENT_DIR, "corrupt.jpg"), "wb") as f:
+            f.write(b"\xff\xd8\xff\xe0 not really a jpeg")
+        image_file = File.objects.create(
+            owner=self.user, name="corrupt.jpg", mime_type="image/jpeg", size=24, file="content/corrupt.jpg"
+        )
+        with self.assertLogs("cloud.previews", "WARNING"):
+            response = self.client.get(reverse("file-preview", args=[image_file.id]), {"size": "icon"})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data, {"error": "Preview not available"})
+
+    def test_sprite(self):
+        video_file = File.objects.create(
+            owner=self.user, name="clip.mp4", mime_type="video/mp4", size=1, file="content/clip.mp4"
+        )
+        url = reverse("file-sprite", args=[video_file.id])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        sprite_path = os.path.join(settings.MEDIA_ROOT, rendition_upload_path(video_file, "sprite.jpg"))
+        os.makedirs(os.path.dirname(sprite_path), exist_ok=True)
+        Image.new("RGB", (800, 450)).save(sprite_path)
+        response = self.client.get(url, HTTP_ACCEPT="image/*")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Sprite-Grid"], "5x5")
+        self.assertTrue(response["X-Accel-Redirect"].endswith("/sprite.jpg"))
+
+    def write_content(self, name, data, mime_type, folder=None):
+        with open(os.path.join(settings.MEDIA_ROOT, name), "wb") as f:
+            f.write(data)
+        return File.objects.create(
+            owner=self.user, name=name, size=len(data), mime_type=mime_type, file=name, folder=folder
+        )
+
+    def test_archive_selected_files(self):
+        text = self.write_content("a.txt", b"hello " * 100, "text/plain")
+        photo = self.write_content("b.jpg", b"\xff\xd8jpeg", "image/jpeg")
+        duplicate = self.write_content("c.txt", b"other", "text/plain")
+        File.objects.filter(pk=duplicate.pk).update(name="a.txt")
+        other_user = User.objects.create_user(username="other", password="password123")
+        foreign = File.objects.create(owner=other_user, name="x.txt", size=1, mime_type="text/plain", file="a.txt")
+
+        response = self.client.post(
+            reverse("file-archive"),
+            {"ids": [str(text.id), str(photo.id), str(duplicate.id), str(foreign.id)]},
+            format="json",
+            HTTP_ACCEPT="application/zip",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/zip")
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(sorted(archive.namelist()), ["a (1).txt", "a.txt", "b.jpg"])
+        self.assertEqual(archive.getinfo("b.jpg").compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.getinfo("a.txt").compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.read("b.jpg"), b"\xff\xd8jpeg")
+
+        response = self.client.post(reverse("file-archive"), {"ids": ["nope"]}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_archive_non_ascii_name(self):
+        folder = Folder.objects.create(owner=self.user, name="Фото")
+        response = self.client.get(reverse("folder-archive", args=[folder.id]))
+        self.assertEqual(response["Content-Disposition"], "attachment; filename*=utf-8''%D0%A4%D0%BE%D1%82%D0%BE.zip")
+        response.close()
+
+    def test_archive_folder_subtree(self):
+        child = Folder.objects.create(owner=self.user, name="child", parent=self.folder)
+        grandchild = Folder.objects.create(owner=self.user, name="grandchild", parent=child)
+        self.write_content("top.txt", b"top", "text/plain", folder=self.folder)
+        self.write_content("deep.txt", b"deep", "text/plain", folder=grandchild)
+        trashed = self.write_content("gone.txt", b"gone", "text/plain", folder=child)
+        trashed.deleted_at = timezone.now()
+        trashed.save()
+
+        response = self.client.get(reverse("folder-archive", args=[self.folder.id]), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="folder.zip"')
+        self.assertNotIn("Content-Encoding", response)
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(
+            sorted(archive.namelist()), ["folder/child/grandchild/deep.txt", "folder/top.txt"]
+        )
+        self.assertEqual(archive.read("folder/child/grandchild/deep.txt"), b"deep")
 
     def test_create_missing_file(self):
         url = reverse("file-list")
@@ -127,6 +367,20 @@ class FileViewSetTests(TestCase):
         self.assertEqual(response.status_code, 403)
         self.assertIn("error", response.data)
 
+    @override_settings(QUOTA_STORAGE_BYTES_PER_USER=5)
+    @mock.patch("cloud.filesystem.views.StorageUsage.has_room", side_effect=[True, False])
+    def test_create_quota_race_stores_nothing(self, has_room):
+        content = b"raced past the pre-check"
+        staging = os.path.join(settings.MEDIA_ROOT, "staging")
+        os.makedirs(staging, exist_ok=True)
+        before = set(os.listdir(staging))
+        data = {"file": SimpleUploadedFile("big.txt", content, content_type="text/plain")}
+        response = self.client.post(reverse("file-list"), data, format="multipart")
+        self.assertEqual(response.status_code, 403)
+        name = blob_upload_path(None, hashlib.sha256(content).hexdigest())
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, name)))
+        self.assertEqual(set(os.listdir(staging)), before)
+
     @override_settings(QUOTA_STORAGE_BYTES_PER_USER=5)
     def test_bulk_upload_quota_exceeded(self):
         url = reverse("file-bulk-upload")
@@ -141,8 +395,8 @@ class FileViewSetTests(TestCase):
         trash_url = reverse("file-trash")
         response = self.client.get(trash_url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]["name"], self.file.name)
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertEqual(response.data["results"][0]["name"], self.file.name)
 
     def test_restore(self):
         url = reverse("file-detail", args=[self.file.id])
@@ -155,6 +409,30 @@ class FileViewSetTests(TestCase):
         self.file.refresh_from_db()
         self.assertIsNone(self.file.deleted_at)
 
+    def test_storage_usage_follows_trash_lifecycle(self):
+        usage = StorageUsage.for_user(self.user.id)
+        self.assertEqual((usage.used_bytes, usage.trash_bytes), (10, 0))
+        self.client.delete(reverse("file-detail", args=[self.file.id]))
+        usage.refresh_from_db()
+        self.assertEqual((usage.used_bytes, usage.trash_bytes), (0, 10))
+        self.client.post(reverse("file-restore", args=[self.file.id]))
+        usage.refresh_from_db()
+        self.assertEqual((usage.used_bytes, usage.trash_bytes), (10, 0))
+        self.client.delete(reverse("file-detail", args=[self.file.id]))
+        self.client.post(reverse("file-permanent-delete", args=[self.file.id]))
+        usage.refresh_from_db()
+        self.assertEqual((usage.used_bytes, usage.trash_bytes), (0, 0))
+
+    @override_settings(QUOTA_STORAGE_BYTES_PER_USER=10)
+    def test_restore_quota_exceeded(self):
+        StorageUsage.for_user(self.user.id)
+        self.client.delete(reverse("file-detail", args=[self.file.id]))
+        StorageUsage.objects.filter(user=self.user).update(used_bytes=5)
+        response = self.client.post(reverse("file-restore", args=[self.file.id]))
+        self.assertEqual(response.status_code, 403)
+        self.file.refresh_from_db()
+        self.assertIsNotNone(self.file.deleted_at)
+
     def test_permanent_delete(self):
         url = reverse("file-detail", args=[self.file.id])
         self.client.delete(url)
@@ -163,9 +441,62 @@ class FileViewSetTests(TestCase):
         self.assertEqual(response.status_code, 204)
         self.assertFalse(File.objects.filter(pk=self.file.id).exists())
 
+    def test_bulk_operations(self):
+        other_user = User.objects.create_user(username="other", password="password123")
+        foreign = File.objects.create(owner=other_user, name="x.txt", size=7, mime_type="text/plain", file="x")
+        second = File.objects.create(owner=self.user, name="b.txt", size=5, mime_type="text/plain", file="b")
+        ids = [str(self.file.id), str(second.id), str(foreign.id)]
+        usage = StorageUsage.for_user(self.user.id)
+
+        response = self.client.post(reverse("file-bulk-move"), {"ids": ids, "folder": self.folder.id}, format="json")
+        self.assertEqual(response.data["count"], 2)
+        self.assertEqual(File.objects.filter(folder=self.folder).count(), 2)
+        foreign.refresh_from_db()
+        self.assertIsNone(foreign.folder_id)
+
+        response = self.client.post(reverse("file-bulk-delete"), {"ids": ids}, format="json")
+        self.assertEqual(response.data["count"], 2)
+        usage.refresh_from_db()
+        self.assertEqual((usage.used_bytes, usage.trash_bytes), (0, 15))
+
+        File.objects.filter(pk=second.pk).update(deleted_at=timezone.now() - timedelta(days=31))
+        response = self.client.post(reverse("file-bulk-restore"), {"ids": ids}, format="json")
+        self.assertEqual(response.data["count"], 1)
+        usage.refresh_from_db()
+        self.assertEqual((usage.used_bytes, usage.trash_bytes), (10, 5))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse("file-bulk-permanent-delete"), {"ids": ids}, format="json")
+        self.assertEqual(response.data["count"], 1)
+        self.assertFalse(File.objects.filter(pk=second.pk).exists())
+        self.assertEqual(File.objects.filter(pk__in=[self.file.pk, foreign.pk]).count(), 2)
+        usage.refresh_from_db()
+        self.assertEqual((usage.used_bytes, usage.trash_bytes), (10, 0))
+
+    @override_settings(QUOTA_STORAGE_BYTES_PER_USER=10)
+    def test_bulk_restore_quota_exceeded(self):
+        StorageUsage.for_user(self.user.id)
+        self.client.post(reverse("file-bulk-delete"), {"ids": [str(self.file.id)]}, format="json")
+        StorageUsage.objects.filter(user=self.user).update(used_bytes=5)
+        response = self.client.post(reverse("file-bulk-restore"), {"ids": [str(self.file.id)]}, format="json")
+        self.assertEqual(response.status_code, 403)
+        self.file.refresh_from_db()
+        self.assertIsNotNone(self.file.deleted_at)
+
+    def test_bulk_rejects_invalid_ids(self):
+        response = self.client.post(reverse("file-bulk-delete"), {"ids": ["nope"]}, format="json")
+        self.assertEqual(response.status_code, 400)
+        with override_settings(BULK_MAX_FILES=1):
+            response = self.client.post(
+                reverse("file-bulk-delete"), {"ids": [str(uuid.uuid4()), str(uuid.uuid4())]}, format="json"
+            )
+        self.assertEqual(response.status_code, 400)
+
 
 class FolderViewSetTests(TestCase):
     def setUp(self):
+        # Folder ids are reused after each test's rollback, and representations are cached by id.
+        cache.clear()
         self.user = User.objects.create_user(username="testuser", password="password123")
         self.client = APIClient()
         self.client.login(username="testuser", password="password123")
@@ -187,6 +518,117 @@ class FolderViewSetTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data[0]["name"], self.folder.name)
 
+    def make_chain(self, length):
+        parent = self.folder
+        for i in range(length):
+            parent = Folder.objects.create(owner=self.user, name=f"sub{i}", parent=parent)
+            File.objects.create(
+                owner=self.user, name=f"f{i}.txt", size=1, mime_type="text/plain", file="f.txt", folder=parent
+            )
+        return parent
+
+    def test_list_folders_query_count_is_constant(self):
+        self.make_chain(5)
+        url = reverse("folder-list")
+        with self.assertNumQueries(4):
+            response = self.client.get(url)
+        self.assertEqual(len(response.data), 1)
+        node = response.data[0]
+        for i in range(5):
+            node = node["children"][0]
+            self.assertEqual(node["name"], f"sub{i}")
+            self.assertEqual(node["files"][0]["name"], f"f{i}.txt")
+        self.assertEqual(node["children"], [])
+
+    def test_list_folders_depth(self):
+        self.make_chain(3)
+        response = self.client.get(reverse("folder-list"), {"depth": 1})
+        child = response.data[0]["children"][0]
+        self.assertEqual(child["name"], "sub0")
+        self.assertIsNone(child["children"])
+        response = self.client.get(reverse("folder-list"), {"depth": "x"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_folders_flat(self):
+        leaf = self.make_chain(2)
+        response = self.client.get(reverse("folder-list"), {"flat": 1})
+        self.assertEqual(len(response.data), 3)
+        by_id = {node["id"]: node for node in response.data}
+        self.assertEqual(by_id[leaf.id]["parent"], leaf.parent_id)
+        self.assertEqual(by_id[leaf.parent_id]["children"], [leaf.id])
+
+    def test_retrieve_folder_loads_only_its_subtree(self):
+        leaf = self.make_chain(2)
+        other = Folder.objects.create(owner=self.user, name="other")
+        File.objects.create(owner=self.user, name="o.txt", size=1, mime_type="text/plain", file="o.txt", folder=other)
+        response = self.client.get(reverse("folder-detail", args=[leaf.parent_id]))
+        self.assertEqual([item["name"] for item in response.data["files"]], ["f0.txt"])
+        self.assertEqual(response.data["children"][0]["files"][0]["name"], "f1.txt")
+
+        response = self.client.get(reverse("folder-content", args=[self.folder.id]))
+        self.assertIsNone(response.data["folders"][0]["children"])
+
+    def test_create_folder_builds_no_tree(self):
+        with self.assertNumQueries(4):
+            response = self.client.post(reverse("folder-list"), {"name": "new"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(response.data["files"])
+
+    def test_move_folder_rewrites_descendant_paths(self):
+        leaf = self.make_chain(2)
+        middle = leaf.parent
+        target = Folder.objects.create(owner=self.user, name="target")
+        url = reverse("folder-detail", args=[middle.id])
+        response = self.client.patch(url, {"parent": target.id}, format="json")
+        self.assertEqual(response.status_code, 200)
+        leaf.refresh_from_db()
+        self.assertEqual(leaf.path, f"/{target.id}/{middle.id}/")
+        self.assertEqual(leaf.ancestor_ids(), [target.id, middle.id])
+
+    def test_move_folder_into_descendant_rejected(self):
+        leaf = self.make_chain(2)
+        url = reverse("folder-detail", args=[self.folder.id])
+        response = self.client.patch(url, {"parent": leaf.id}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_concurrent_cross_moves_cannot_cycle(self):
+        other = Folder.objects.create(owner=self.user, name="other")
+        response = self.client.patch(reverse("folder-detail", args=[self.folder.id]), {"parent": other.id}, format="json")
+        self.assertEqual(response.status_code, 200)
+        # The second request validated against paths read before the first one committed.
+        with mock.patch.object(FolderSerializer, "validate_parent", lambda serializer, value: value):
+            response = self.client.patch(reverse("folder-detail", args=[other.id]), {"parent": self.folder.id}, format="json")
+        self.assertEqual(response.status_code, 400)
+        other.refresh_from_db()
+        self.assertIsNone(other.parent_id)
+        self.assertEqual(other.path, "/")
+
+    def test_delete_folder_soft_deletes_subtree_files(self):
+        self.make_chain(3)
+        response = self.client.delete(reverse("folder-detail", args=[self.folder.id]))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Folder.objects.filter(owner=self.user).exists())
+        self.assertFalse(File.objects.filter(owner=self.user, deleted_at__isnull=True).exists())
+
+    def test_delete_folder_counts_trashed_files_once(self):
+        usage = StorageUsage.for_user(self.user.id)
+        used, trash = usage.used_bytes, usage.trash_bytes
+        # A concurrent request trashed the file first.
+        File.objects.filter(pk=self.file.pk).trash()
+        response = self.client.delete(reverse("folder-detail", args=[self.folder.id]))
+        self.assertEqual(response.status_code, 204)
+        usage.refresh_from_db()
+        self.assertEqual((usage.used_bytes, usage.trash_bytes), (used - 10, trash + 10))
+        self.file.refresh_from_db()
+        self.assertIsNone(self.file.folder_id)
+
+    def test_breadcrumbs_and_size(self):
+        leaf = self.make_chain(2)
+        response = self.client.get(reverse("folder-breadcrumbs", args=[leaf.id]))
+        self.assertEqual([item["name"] for item in response.data], ["folder", "sub0", "sub1"])
+        response = self.client.get(reverse("folder-size", args=[self.folder.id]))
+        self.assertEqual(response.data, {"size": 12, "files": 3})
+
     def test_folder_content(self):
         url = reverse("folder-content", args=[self.folder.id])
         response = self.client.get(url)
@@ -204,8 +646,97 @@ class FolderViewSetTests(TestCase):
         self.assertIsNotNone(self.file.deleted_at)
 
 
+class UploadSessionViewSetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password123")
+        self.client = APIClient()
+        self.client.login(username="testuser", password="password123")
+        self.folder = Folder.objects.create(owner=self.user, name="folder")
+
+    def open_session(self, size=10):
+        url = reverse("upload-list")
+        response = self.client.post(
+            url, {"name": "video.mp4", "size": size, "folder": self.folder.id}, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.data["id"]
+
+    def put_chunk(self, session_id, data, start, total):
+        url = reverse("upload-chunk", args=[session_id])
+        return self.client.put(
+            url,
+            data,
+            content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE=f"bytes {start}-{start + len(data) - 1}/{total}",
+        )
+
+    @mock.patch("cloud.filesystem.views.queue_previews")
+    def test_chunked_upload(self, queue_previews_mock):
+        session_id = self.open_session()
+        response = self.put_chunk(session_id, b"01234", 0, 10)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["offset"], 5)
+        response = self.put_chunk(session_id, b"56789", 5, 10)
+        self.assertEqual(response.data["offset"], 10)
+
+        response = self.client.post(reverse("upload-commit", args=[session_id]))
+        self.assertEqual(response.status_code, 201)
+        file_obj = File.objects.get(pk=response.data["id"])
+        self.assertEqual(file_obj.folder, self.folder)
+        self.assertEqual(file_obj.mime_type, "video/mp4")
+        with file_obj.file.open("rb") as f:
+            self.assertEqual(f.read(), b"0123456789")
+        self.assertFalse(UploadSession.objects.filter(pk=session_id).exists())
+        queue_previews_mock.assert_called_once_with([file_obj], interactive=True)
+
+    def test_chunk_offset_mismatch(self):
+        session_id = self.open_session()
+        self.put_chunk(session_id, b"01234", 0, 10)
+        response = self.put_chunk(session_id, b"56789", 3, 10)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data["offset"], 5)
+        response = self.client.get(reverse("upload-detail", args=[session_id]))
+        self.assertEqual(response.data["offset"], 5)
+
+    def test_chunk_written_outside_lock(self):
+        session_id = self.open_session()
+        self.put_chunk(session_id, b"01234", 0, 10)
+        staging = os.path.join(settings.MEDIA_ROOT, "staging")
+        before = set(os.listdir(staging))
+
+        with mock.patch.object(UploadSession, "received", side_effect=[5, 7], autospec=True):
+            response = self.put_chunk(session_id, b"56789", 5, 10)
+
+        # Another request appended while this body was streaming; the part is discarded.
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data["offset"], 7)
+        self.assertEqual(set(os.listdir(staging)), before)
+        self.assertEqual(self.client.get(reverse("upload-detail", args=[session_id])).data["offset"], 5)
+
+    def test_commit_incomplete(self):
+        session_id = self.open_session()
+        self.put_chunk(session_id, b"01234", 0, 10)
+        response = self.client.post(reverse("upload-commit", args=[session_id]))
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(File.objects.filter(name="video.mp4").exists())
+
+    @override_settings(QUOTA_STORAGE_BYTES_PER_USER=5)
+    def test_open_quota_exceeded(self):
+        response = self.client.post(reverse("upload-list"), {"name": "big.bin", "size": 10}, format="json")
+        self.assertEqual(response.status_code, 403)
+
+    def test_abort(self):
+        session_id = self.open_session()
+        self.put_chunk(session_id, b"01234", 0, 10)
+        path = UploadSession.objects.get(pk=session_id).path
+        response = self.client.delete(reverse("upload-detail", args=[session_id]))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, path)))
+
+
 class PublicSharedFileViewTests(TestCase):
     def setUp(self):
+        cache.clear()
         self.user = User.objects.create_user(username="testuser", password="password123")
         self.client = APIClient()
         self.client.login(username="testuser", password="password123")
@@ -230,6 +761,73 @@ class PublicSharedFileViewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn("X-Accel-Redirect", response)
 
+    def test_public_shared_file_revalidation_is_not_a_download(self):
+        url = reverse("public-file", args=[self.shared_link.token])
+        response = self.client.get(url)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.shared_link.refresh_from_db()
+        self.assertEqual(self.shared_link.download_count, 1)
+
+    def test_public_shared_file_resumed_range_is_not_a_download(self):
+        self.shared_link.max_downloads = 2
+        self.shared_link.save()
+        url = reverse("public-file", args=[self.shared_link.token])
+        statuses = [self.client.get(url, HTTP_RANGE=f"bytes={start}-").status_code for start in (0, 4, 7, 0)]
+        self.assertEqual(statuses, [200, 200, 200, 200])
+        self.shared_link.refresh_from_db()
+        self.assertEqual(self.shared_link.download_count, 2)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_public_shared_file_exhausted_link_refuses_ranges(self):
+        self.shared_link.max_downloads = 1
+        self.shared_link.save()
+        url = reverse("public-file", args=[self.shared_link.token])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        statuses = [self.client.get(url, HTTP_RANGE=header).status_code for header in ("bytes=-100000", "bytes=1-")]
+        self.assertEqual(statuses, [404, 404])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.shared_link.refresh_from_db()
+        self.assertEqual(self.shared_link.download_count, 1)
+
+    def test_public_shared_file_suffix_range_is_a_download(self):
+        url = reverse("public-file", args=[self.shared_link.token])
+        self.assertEqual(self.client.get(url, HTTP_RANGE="bytes=-100000").status_code, 200)
+        self.shared_link.refresh_from_db()
+        self.assertEqual(self.shared_link.download_count, 1)
+
+    def test_public_shared_file_resolution_is_cached(self):
+        url = reverse("public-file", args=[self.shared_link.token])
+        response = self.client.get(url)
+        # The remaining query is the session user lookup.
+        with self.assertNumQueries(2):
+            self.client.get(url)
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+        unknown = reverse("public-file", args=[uuid.uuid4()])
+        self.client.get(unknown)
+        with self.assertNumQueries(1):
+            response = self.client.get(unknown)
+        self.assertEqual(response.status_code, 404)
+
+    def test_public_shared_file_enforces_max_downloads_atomically(self):
+        self.shared_link.max_downloads = 2
+        self.shared_link.save()
+        url = reverse("public-file", args=[self.shared_link.token])
+        statuses = [self.client.get(url).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 404])
+        self.shared_link.refresh_from_db()
+        self.assertEqual(self.shared_link.download_count, 2)
+
+    def test_public_shared_file_cache_invalidated_on_delete(self):
+        url = reverse("public-file", args=[self.shared_link.token])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shared_link.delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
     def test_public_shared_file_expired(self):
         self.shared_link.expires_at = timezone.now() - timedelta(minutes=1)
         self.shared_link.save()
@@ -243,3 +841,217 @@ class PublicSharedFileViewTests(TestCase):
         url = reverse("public-file", args=[self.shared_link.token])
         response = self.client.get(url)
         self.assertEqual(response.status_code, 404)
+
+
+class SignedMediaTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password123")
+        self.client = APIClient()
+        self.client.login(username="testuser", password="password123")
+        self.file = File.objects.create(
+            owner=self.user,
+            name="report.txt",
+            size=10,
+            mime_type="text/plain",
+            file="content/report.txt",
+            preview_image="previews/report.jpeg",
+        )
+
+    def get_urls(self):
+        response = self.client.get(reverse("file-detail", args=[self.file.id]))
+        return response.data["download_url"], response.data["preview_url"]
+
+    def test_signed_urls_skip_session_and_database(self):
+        download_url, preview_url = self.get_urls()
+        anonymous = APIClient()
+        with self.assertNumQueries(0):
+            response = anonymous.get(download_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], "/protected-media/content/report.txt")
+        self.assertEqual(response["Content-Type"], "text/plain")
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="report.txt"')
+        self.assertTrue(response["Cache-Control"].startswith("private, max-age="))
+
+        with self.assertNumQueries(0):
+            response = anonymous.get(preview_url)
+        self.assertEqual(response["X-Accel-Redirect"], "/protected-media/previews/report.jpeg")
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertNotIn("Content-Disposition", response)
+
+    def test_signed_urls_are_stable_within_the_ttl(self):
+        self.assertEqual(self.get_urls(), self.get_urls())
+
+    def test_tampered_signature_is_refused(self):
+        download_url, _ = self.get_urls()
+        self.assertEqual(self.client.get(download_url.replace("report.txt", "other.txt", 1)).status_code, 403)
+        self.assertEqual(self.client.get(download_url.replace("f=report.txt", "f=x.html")).status_code, 403)
+        self.assertEqual(self.client.get(reverse("signed-media", args=["content/report.txt"])).status_code, 403)
+
+    def test_expired_url_is_gone(self):
+        with mock.patch("cloud.filesystem.signing.time.time", return_value=time.time() - 3 * settings.SIGNED_URL_TTL):
+            download_url, _ = self.get_urls()
+        self.assertEqual(self.client.get(download_url).status_code, 410)
+
+    def test_trashed_file_is_not_signed(self):
+        self.file.deleted_at = timezone.now()
+        self.file.save(update_fields=["deleted_at"])
+        response = self.client.get(reverse("file-trash"))
+        self.assertTrue(response.data["results"][0]["download_url"].endswith(f"/api/files/{self.file.id}/download/"))
+
+    @override_settings(SIGNED_URL_MODE="nginx", SIGNED_URL_SECRET="secret")
+    def test_nginx_secure_link_mode(self):
+        download_url, _ = self.get_urls()
+        path, query = download_url.split("?")
+        self.assertTrue(path.endswith("/signed-media/content/report.txt"))
+        params = dict(param.split("=") for param in query.split("&"))
+        value = f"{params['expires']}/signed-media/content/report.txt{self.user.id} secret"
+        digest = base64.urlsafe_b64encode(hashlib.md5(value.encode()).digest()).rstrip(b"=").decode()
+        self.assertEqual(params["md5"], digest)
+
+
+class RepresentationCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="password123")
+        self.client = APIClient()
+        self.client.login(username="testuser", password="password123")
+        self.folder = Folder.objects.create(owner=self.user, name="folder")
+        self.file = File.objects.create(
+            owner=self.user, name="file.txt", size=10, mime_type="text/plain", file="file.txt", folder=self.folder
+        )
+
+    def list_names(self):
+        return [item["name"] for item in self.client.get(reverse("file-list")).data["results"]]
+
+    def test_file_list_is_served_from_cache_until_updated(self):
+        self.assertEqual(self.list_names(), ["file.txt"])
+        self.file.refresh_from_db()
+        key = FileSerializer(context={"request": APIRequestFactory().get("/")}).cache_key(self.file)
+        cache.set(key, {**cache.get(key), "name": "cached.txt"})
+        self.assertEqual(self.list_names(), ["cached.txt"])
+
+        self.client.patch(reverse("file-detail", args=[self.file.id]), {"name": "renamed.txt"}, format="json")
+        self.assertEqual(self.list_names(), ["renamed.txt"])
+
+    def test_bulk_move_refreshes_cached_files(self):
+        self.client.get(reverse("folder-content", args=[self.folder.id]))
+        self.client.post(reverse("file-bulk-move"), {"ids": [str(self.file.id)], "folder": None}, format="json")
+        response = self.client.get(reverse("file-list"))
+        self.assertIsNone(response.data["results"][0]["folder"])
+
+    def test_folder_rename_bumps_version(self):
+        self.client.get(reverse("folder-list"))
+        self.client.patch(reverse("folder-detail", args=[self.folder.id]), {"name": "renamed"}, format="json")
+        self.folder.refresh_from_db()
+        self.assertEqual(self.folder.version, 1)
+        response = self.client.get(reverse("folder-list"))
+        self.assertEqual(response.data[0]["name"], "renamed")
+        self.assertEqual(response.data[0]["files"][0]["name"], "file.txt")
+
+
+class SyncTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="password123")
+        self.client = APIClient()
+        self.client.login(username="testuser", password="password123")
+        self.folder = Folder.objects.create(owner=self.user, name="folder")
+        self.file = File.objects.create(
+            owner=self.user, name="file.txt", size=10, mime_type="text/plain", file="file.txt", folder=self.folder
+        )
+        StorageUsage.for_user(self.user.id)
+
+    def changes(self, since):
+        response = self.client.get(reverse("changes"), {"since": since})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_listing_etag(self):
+        for url in [reverse("file-list"), reverse("folder-list"), reverse("folder-content", args=[self.folder.id])]:
+            response = self.client.get(url)
+            etag = response["ETag"]
+            self.assertEqual(response["Cache-Control"], "private, no-cache")
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response["ETag"], etag)
+
+        url = reverse("file-list")
+        etag = self.client.get(url)["ETag"]
+        self.client.patch(reverse("file-detail", args=[self.file.id]), {"name": "renamed.txt"}, format="json")
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["results"][0]["name"], "renamed.txt")
+
+    def test_listing_etag_is_per_user(self):
+        url = reverse("file-list")
+        etag = self.client.get(url)["ETag"]
+        File.objects.create(owner=self.user, name="new.txt", size=1, mime_type="text/plain", file="new.txt")
+        self.assertNotEqual(self.client.get(url)["ETag"], etag)
+
+        etag = self.client.get(url)["ETag"]
+        other = User.objects.create_user(username="other", password="password123")
+        File.objects.create(owner=other, name="other.txt", size=1, mime_type="text/plain", file="other.txt")
+        self.assertEqual(self.client.get(url, headers={"If-None-Match": etag}).status_code, 304)
+
+    def test_changes_feed(self):
+        data = self.changes(0)
+        self.assertFalse(data["more"])
+        self.assertEqual([item["id"] for item in data["files"]], [str(self.file.id)])
+        self.assertEqual([item["id"] for item in data["folders"]], [self.folder.id])
+        token = data["token"]
+        self.assertEqual(self.changes(token)["files"], [])
+
+        self.client.patch(reverse("file-detail", args=[self.file.id]), {"name": "renamed.txt"}, format="json")
+        self.client.patch(reverse("folder-detail", args=[self.folder.id]), {"name": "renamed"}, format="json")
+        data = self.changes(token)
+        self.assertEqual([item["name"] for item in data["files"]], ["renamed.txt"])
+        self.assertEqual([item["name"] for item in data["folders"]], ["renamed"])
+        token = data["token"]
+
+        self.client.post(reverse("file-bulk-move"), {"ids": [str(self.file.id)], "folder": None}, format="json")
+        data = self.changes(token)
+        self.assertIsNone(data["files"][0]["folder"])
+        token = data["token"]
+
+        self.client.delete(reverse("file-detail", args=[self.file.id]))
+        data = self.changes(token)
+        self.assertEqual(data["deleted"]["files"], [str(self.file.id)])
+        token = data["token"]
+
+        self.client.post(reverse("file-permanent-delete", args=[self.file.id]))
+        self.client.delete(reverse("folder-detail", args=[self.folder.id]))
+        data = self.changes(token)
+        self.assertEqual(data["files"], [])
+        self.assertEqual(data["deleted"], {"files": [str(self.file.id)], "folders": [self.folder.id]})
+
+    @mock.patch("cloud.filesystem.views.queue_previews")
+    def test_bulk_upload_takes_one_change(self, queue_previews):
+        token = self.changes(0)["token"]
+        uploads = [SimpleUploadedFile(f"{i}.txt", f"content {i}".encode(), content_type="text/plain") for i in range(3)]
+        response = self.client.post(reverse("file-bulk-upload"), {"files": uploads}, format="multipart")
+        self.assertEqual(response.status_code, 201)
+        data = self.changes(token)
+        self.assertEqual(data["token"], token + 1)
+        self.assertCountEqual([item["name"] for item in data["files"]], ["0.txt", "1.txt", "2.txt"])
+
+    @override_settings(CHANGES_PAGE_SIZE=1)
+    def test_changes_feed_pages(self):
+        File.objects.create(owner=self.user, name="second.txt", size=1, mime_type="text/plain", file="second.txt")
+        data = self.changes(0)
+        self.assertTrue(data["more"])
+        self.assertEqual(len(data["files"]), 1)
+        data = self.changes(data["token"])
+        self.assertFalse(data["more"])
+        self.assertEqual([item["name"] for item in data["files"]], ["second.txt"])
+
+    def test_changes_feed_rejects_bad_tokens(self):
+        self.assertEqual(self.client.get(reverse("changes"), {"since": "x"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("changes"), {"since": 1000}).status_code, 400)
+
+    def test_changes_feed_after_pruning(self):
+        token = self.changes(0)["token"]
+        self.client.delete(reverse("folder-detail", args=[self.folder.id]))
+        Tombstone.prune(timezone.now() + timedelta(seconds=1))
+        response = self.client.get(reverse("changes"), {"since": token})
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(self.changes(0)["deleted"]["folders"], [])
@@ -22,6 +22,8 @@ from drf_yasg import openapi
 from drf_yasg.views import get_schema_view
 from rest_framework import permissions
 
+from cloud.metrics import metrics_view
+
 
 schema_view = get_schema_view(
    openapi.Info(
@@ -39,6 +41,7 @@ urlpatterns = [
     path('docs', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     path('redoc', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
     path("api/", include('cloud.filesystem.urls')),
+    path("metrics", metrics_view, name="metrics"),
 ]
 
 
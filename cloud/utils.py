@@ -1,3 +1,11 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+
 def file_upload_path(instance, filename):
     ext = filename.split('.')[-1]
     uid = str(instance.id).replace('-', '')
@@ -7,3 +15,38 @@ def file_upload_path(instance, filename):
 def preview_upload_path(instance, filename):
     uid = str(instance.id).replace('-', '')
     return f"previews/{uid[:2]}/{uid[2:4]}/{instance.id}.jpeg"
+
+
+def rendition_upload_path(instance, filename):
+    return f"{rendition_dir(instance.id)}/{filename}"
+
+
+def rendition_dir(file_id):
+    uid = str(file_id).replace('-', '')
+    return f"renditions/{uid[:2]}/{uid[2:4]}/{file_id}"
+
+
+def blob_upload_path(instance, filename):
+    return f"blobs/{filename[:2]}/{filename[2:4]}/{filename}"
+
+
+def staging_upload_path(instance, filename):
+    return f"staging/{filename}"
+
+
+def delete_path(name):
+    path = default_storage.path(name)
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        default_storage.delete(name)
+
+
+def unlink_files(names):
+    names = [name for name in names if name]
+    if len(names) <= 1:
+        for name in names:
+            delete_path(name)
+        return
+    with ThreadPoolExecutor(max_workers=settings.PURGE_UNLINK_WORKERS) as pool:
+        list(pool.map(delete_path, names))
@@ -0,0 +1,104 @@
+import json
+import os
+import resource
+import subprocess
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+import ffmpeg
+
+from cloud.utils import rendition_upload_path
+
+
+SPRITE_NAME = "sprite.jpg"
+
+
+class VideoError(Exception):
+    pass
+
+
+def _limit_resources():
+    memory = settings.VIDEO_MEMORY_LIMIT_BYTES
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+
+def run(args, timeout):
+    try:
+        result = subprocess.run(  # noqa: S603
+            args,
+            capture_output=True,
+            timeout=timeout,
+            preexec_fn=_limit_resources,
+            check=False,
+        )
+    except subprocess.TimeoutExpired:
+        raise VideoError(f"{args[0]} timed out after {timeout}s") from None
+    if result.returncode != 0:
+        raise VideoError(result.stderr.decode(errors="replace").strip()[-500:])
+    return result.stdout
+
+
+def probe(path):
+    stdout = run(
+        [
+            "ffprobe", "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "stream=codec_name,width,height,duration:format=duration",
+            "-of", "json", path,
+        ],
+        settings.VIDEO_PROBE_TIMEOUT,
+    )
+    info = json.loads(stdout)
+    streams = info.get("streams") or [{}]
+    stream = streams[0]
+    duration = stream.get("duration") or info.get("format", {}).get("duration")
+    return {
+        "duration_ms": round(float(duration) * 1000) if duration else None,
+        "width": stream.get("width"),
+        "height": stream.get("height"),
+        "video_codec": stream.get("codec_name", "")[:32],
+    }
+
+
+def _keyframes(path, seek):
+    # Input-side seeking jumps straight to the nearest keyframe and only keyframes get decoded.
+    return ffmpeg.input(path, ss=seek, skip_frame="nokey", threads=1)
+
+
+def poster(path, duration_ms):
+    seek = min((duration_ms or 0) / 1000 * 0.1, settings.VIDEO_POSTER_MAX_SEEK)
+    args = (
+        _keyframes(path, seek)
+        .filter("scale", 300, -2)
+        .output("pipe:", vframes=1, format="image2", vcodec="mjpeg")
+        .compile()
+    )
+    return run(args, settings.VIDEO_FFMPEG_TIMEOUT) or None
+
+
+def sprite(file, duration_ms):
+    columns, rows = settings.VIDEO_SPRITE_GRID
+    frames = columns * rows
+    if not duration_ms:
+        return None
+
+    name = rendition_upload_path(file, SPRITE_NAME)
+    path = default_storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp.jpg"
+    args = (
+        _keyframes(file.file.path, 0)
+        .filter("fps", frames * 1000 / duration_ms)
+        .filter("scale", settings.VIDEO_SPRITE_TILE_WIDTH, -2)
+        .filter("tile", f"{columns}x{rows}")
+        .output(tmp_path, vframes=1, format="image2", vcodec="mjpeg")
+        .compile()
+    )
+    try:
+        run(args, settings.VIDEO_FFMPEG_TIMEOUT)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return name